@@ -9,11 +9,13 @@ __version__ = '0.2.1'
 __description__ = 'The Python utility library'
 
 
+import sys
+
+
 # Check Environment ###########################################################
 ###############################################################################
 def check_environment():
-    import platform
-    if platform.python_version_tuple() < ('3', '6') or platform.python_implementation() != 'CPython':
+    if sys.version_info < (3, 6) or sys.implementation.name != 'cpython':
         raise RuntimeError('Sampan requires CPython 3.6 or greater.')
 
 
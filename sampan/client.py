@@ -2,10 +2,14 @@
 # coding: utf-8
 
 
-import base64
 import ssl
+import binascii
 import os
 import mimetypes
+import queue
+import threading
+from functools import lru_cache
+from collections import ChainMap, OrderedDict
 from urllib import parse
 from http import client
 
@@ -13,19 +17,141 @@ from http import client
 __all__ = ['BasicAuthentication', 'RestClient']
 
 
+_DEFAULT_SSL_CTX = None
+_SSL_CTX_LOCK = threading.Lock()
+
+
+def _get_ssl_ctx():
+    # Building a context loads the CA store, so do it once and share it
+    global _DEFAULT_SSL_CTX
+    if _DEFAULT_SSL_CTX is None:
+        with _SSL_CTX_LOCK:
+            if _DEFAULT_SSL_CTX is None:
+                _DEFAULT_SSL_CTX = ssl._create_unverified_context()
+    return _DEFAULT_SSL_CTX
+
+
+mimetypes.init()
+_EXT_TO_CT = dict(mimetypes.types_map)
+_EXT_TO_CT['.json'] = 'application/json'
+
+
+# last TLS session per (host, port), least recently used first
+_SSL_SESSIONS = OrderedDict()
+_SSL_SESSIONS_LOCK = threading.Lock()
+_SSL_SESSIONS_SIZE = 64
+
+
+def _get_ssl_session(key):
+    with _SSL_SESSIONS_LOCK:
+        session = _SSL_SESSIONS.get(key)
+        if session is not None:
+            _SSL_SESSIONS.move_to_end(key)
+        return session
+
+
+def _put_ssl_session(key, session):
+    with _SSL_SESSIONS_LOCK:
+        _SSL_SESSIONS[key] = session
+        _SSL_SESSIONS.move_to_end(key)
+        if len(_SSL_SESSIONS) > _SSL_SESSIONS_SIZE:
+            _SSL_SESSIONS.popitem(last=False)
+
+
+class _HTTPSConnection(client.HTTPSConnection):
+    """HTTPS connection that resumes the last TLS session seen for its host.
+
+    Pooled connections are reopened whenever the server drops keep-alive;
+    offering the cached session lets the reconnect skip the full handshake.
+    """
+
+    def connect(self):
+        client.HTTPConnection.connect(self)
+        # behind a proxy the session belongs to the tunnelled host, not the proxy
+        key = (self._tunnel_host, self._tunnel_port) if self._tunnel_host else (self.host, self.port)
+        session = _get_ssl_session(key)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host,
+                                              session=session)
+        new_session = self.sock.session
+        if new_session is not None and (not self.sock.session_reused or new_session != session):
+            _put_ssl_session(key, new_session)
+
+
+# equal values of different types (1, True) encode differently, so only flat
+# scalars are cached and their types are part of the key; floats are left out
+# because equal floats can still encode differently (0.0 and -0.0)
+_CACHEABLE_TYPES = frozenset({str, bytes, int, bool, type(None)})
+
+
+@lru_cache(maxsize=256)
+def _cached_urlencode(items, types):
+    return parse.urlencode(items)
+
+
+def _urlencode(args):
+    items = tuple(args.items()) if hasattr(args, 'items') else tuple(args)
+    try:
+        types = tuple(type(v) for item in items for v in item)
+    except TypeError:
+        return parse.urlencode(args)
+    if not _CACHEABLE_TYPES.issuperset(types):
+        return parse.urlencode(args)
+    return _cached_urlencode(items, types)
+
+
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+_POOL_SIZE = 8
+_PREALLOC_SIZE = 1024 * 1024
+
+
+def _get_pool(key):
+    pool = _POOL.get(key)
+    if pool is None:
+        with _POOL_LOCK:
+            pool = _POOL.setdefault(key, queue.LifoQueue(_POOL_SIZE))
+    return pool
+
+
+class _MultipartBody:
+    """Iterable request body that streams file parts from disk.
+
+    ``parts`` holds encoded ``bytes`` and ``(path, size)`` pairs; files are
+    read in ``CHUNK_SIZE`` blocks while sending, and ``len()`` gives the
+    Content-Length without touching them.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(len(part) if isinstance(part, bytes) else part[1] for part in parts)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                with open(part[0], 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                        yield chunk
+
+
 class BasicAuthentication:
     BASIC_AUTH_KEY = 'Authorization'
     BASIC_AUTH_VALUE_PREFIX = 'Basic '
 
     def __init__(self, username, password):
         self.username = username
-        self.password = password
         self.value = None
         self.reset(username, password)
 
     def reset(self, username, password):
-        _auth_value = base64.encodebytes('{}:{}'.format(username, password).strip())
-        self.value = '{}{}'.format(BasicAuthentication.BASIC_AUTH_VALUE_PREFIX, _auth_value)
+        self.username = username
+        _auth_value = binascii.b2a_base64('{}:{}'.format(username, password).encode('utf-8'), newline=False)
+        self.value = BasicAuthentication.BASIC_AUTH_VALUE_PREFIX + _auth_value.decode('ascii')
 
     def get_key(self):
         return BasicAuthentication.BASIC_AUTH_KEY
@@ -41,22 +167,72 @@ class RestClient:
     REQUEST_TIMEOUT = 30
 
     def __init__(self, base_url):
-        mimetypes.add_type('application/json', '.json')
         self.base_url = base_url
         self.pr = parse.urlparse(self.base_url)
         self.headers = {'User-Agent': 'Basic Agent'}
-
-        if self.pr.scheme == 'http':
-            self.con = client.HTTPConnection(self.pr.netloc, timeout=self.REQUEST_TIMEOUT)
-        else:
-            self.con = client.HTTPSConnection(self.pr.netloc, timeout=self.REQUEST_TIMEOUT, context=ssl._create_unverified_context())
+        self.base_path = self.pr.path if self.pr.path.endswith('/') else '{}/'.format(self.pr.path)
+        self.pool_key = (self.pr.scheme, self.pr.netloc)
 
     def set_basic_authentication(self, basic_auth):
         self.headers[basic_auth.get_key()] = basic_auth.get_value()
 
     def disconnect(self):
-        if self.con:
-            self.con.close()
+        pool = _get_pool(self.pool_key)
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def _connect(self):
+        if self.pr.scheme == 'http':
+            return client.HTTPConnection(self.pr.netloc, timeout=self.REQUEST_TIMEOUT)
+        return _HTTPSConnection(self.pr.netloc, timeout=self.REQUEST_TIMEOUT, context=_get_ssl_ctx())
+
+    def _acquire(self):
+        try:
+            return _get_pool(self.pool_key).get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, con):
+        try:
+            _get_pool(self.pool_key).put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    @staticmethod
+    def _read_body(resp):
+        # http.client leaves length None when it is unknown and sets it to 0 when no body follows (HEAD, 204, 304)
+        length = resp.length
+        if not length:
+            return resp.read()
+        # the header is only trusted up to a cap, the buffer grows as data actually arrives
+        buf = bytearray(min(length, _PREALLOC_SIZE))
+        pos = 0
+        while pos < length:
+            if pos == len(buf):
+                buf.extend(bytes(min(len(buf), length - pos)))
+            with memoryview(buf) as mv, mv[pos:] as view:
+                n = resp.readinto(view)
+            if not n:
+                # the connection closed early, fail like resp.read() instead of returning part of the body
+                raise client.IncompleteRead(bytes(buf[:pos]), length - pos)
+            pos += n
+        return bytes(buf)
+
+    def _send(self, method, path, body, headers):
+        con = self._acquire()
+        try:
+            con.request(method=method.upper(), url=path, body=body, headers=headers)
+            resp = con.getresponse()
+            resp_map = {'status': resp.status, 'reason': resp.reason, 'headers': resp.getheaders(),
+                        'body': self._read_body(resp)}
+        except Exception:
+            con.close()
+            raise
+        self._release(con)
+        return resp_map
 
     def reset_headers(self):
         self.headers.clear()
@@ -81,13 +257,13 @@ class RestClient:
             self.headers['Accept'] = '*/*'
 
     def _get_content_type(self, filename):
-        return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return _EXT_TO_CT.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
 
     def _get_full_url(self, path, args):
+        url = self.base_path + (path[1:] if path.startswith('/') else path)
         if args:
-            path += '?' + parse.urlencode(args)
-        return parse.urljoin(self.pr.path if self.pr.path.endswith('/') else '{}/'.format(self.pr.path),
-                             path[1:] if path.startswith('/') else path)
+            return url + '?' + _urlencode(args)
+        return url
 
     '''def _get_files_list(self, files):
         _files = []
@@ -106,51 +282,35 @@ class RestClient:
         else:
             _name = 'files[]'
         for _file in files:
-            _filename = os.path.basename(_file)
-            with open(_file, 'rb') as f:
-                _file_value = f.read()
-            _files.append((_name, _filename, _file_value))
+            _files.append((_name, os.path.basename(_file), _file, os.path.getsize(_file)))
         return _files
 
     def encode_multipart_formdata(self, fields, files):
         BOUNDARY = 'Boundary_1_240630125_1477681764147'
-        CRLF = '\r\n'
-        chunks = []
+        parts = []
         for (key, value) in fields:
-            chunks.append('--' + BOUNDARY)
-            chunks.append('Content-Disposition: form-data; name="{}"'.format(key))
-            chunks.append('Content-Type: application/json')
-            chunks.append('')
-            chunks.append(str(value))
-        for (key, filename, value) in files:
-            chunks.append('--' + BOUNDARY)
-            chunks.append('Content-Disposition: form-data; name="{}"; filename="{}"'.format(key, filename))
-            chunks.append('Content-Type: {}'.format(self._get_content_type(filename)))
-            chunks.append('')
-            if filename.endswith('.pdf'):
-                chunks.append(str(value.decode('ISO8859-1')))
-            else:
-                chunks.append(str(value.decode('utf8')))
-        chunks.append('--' + BOUNDARY + '--')
-        chunks.append('')
-        chunks = [str(chunk) for chunk in chunks]
-        body = CRLF.join(chunks)
+            parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n'
+                         'Content-Type: application/json\r\n\r\n'.format(BOUNDARY, key).encode('utf-8'))
+            parts.append(value if isinstance(value, bytes) else str(value).encode('utf-8'))
+            parts.append(b'\r\n')
+        for (key, filename, path, size) in files:
+            parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                         'Content-Type: {}\r\n\r\n'.format(BOUNDARY, key, filename,
+                                                          self._get_content_type(filename)).encode('utf-8'))
+            parts.append((path, size))
+            parts.append(b'\r\n')
+        parts.append('--{}--\r\n'.format(BOUNDARY).encode('utf-8'))
+        body = _MultipartBody(parts)
         content_type = 'multipart/form-data; boundary={}'.format(BOUNDARY)
         return content_type, body
 
     def invoke_non_multipart(self, method, path, args=None, headers=None):
-        _headers = headers if headers is not None else {}
         _path = self._get_full_url(path, args)
-        _headers['Content-Length'] = '0'
-        _headers['Content-Type'] = 'text/xml'
-        _headers.update(self.headers)
-        self.con.request(method=method.upper(), url=_path, body=None, headers=_headers)
-        resp = self.con.getresponse()
-        resp_map = {'status': resp.status, 'reason': resp.reason, 'headers': resp.getheaders(), 'body': resp.read()}
-        return resp_map
+        _headers = {'Content-Length': '0', 'Content-Type': 'text/xml'}
+        return self._send(method, _path, None, ChainMap(self.headers, _headers, headers or {}))
 
     def invoke_multipart(self, method, path, args=None, headers=None, body=None, files=None):
-        _headers = headers if headers is not None else {}
+        _headers = {}
         _path = self._get_full_url(path, args)
 
         if body and files:
@@ -167,18 +327,14 @@ class RestClient:
             _headers['Content-Type'] = content_type
         elif body:
             _body = body
-            if not _headers.get('Content-Type', None):
-                _headers['Content-Type'] = mimetypes.types_map['.json']
+            if not (headers and headers.get('Content-Type', None)):
+                _headers['Content-Type'] = _EXT_TO_CT['.json']
             _headers['Content-Length'] = str(len(body))
         else:
             _body = None
             _headers['Content-Type'] = 'text/xml'
             _headers['Content-Length'] = '0'
-        _headers.update(self.headers)
-        self.con.request(method=method.upper(), url=_path, body=_body, headers=_headers)
-        resp = self.con.getresponse()
-        resp_map = {'status': resp.status, 'reason': resp.reason, 'headers': resp.getheaders(), 'body': resp.read()}
-        return resp_map
+        return self._send(method, _path, _body, ChainMap(self.headers, _headers, headers or {}))
 
     def request_get(self, path, args=None, headers=None):
         return self.invoke_non_multipart(method='get', path=path, args=args, headers=headers)
@@ -5,7 +5,8 @@ import re
 import sys
 import typing
 import time
-from collections import OrderedDict, abc
+from functools import lru_cache
+from collections import abc
 
 """ A Python implementation for java.util.Properties """
 
@@ -16,6 +17,14 @@ __all__ = ['Properties']
 ###############################################################################
 DMT = '%a %b %d %H:%M:%S %Z %Y'
 ENCODING = 'latin-1'
+RE_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|.?)', re.DOTALL)
+ESCAPES = {'t': '\t', 'r': '\r', 'n': '\n', 'f': '\f', '|': '|'}
+# '|' separates keys from values like '=' and ':', see Properties.re_property
+ESCAPE_TABLE = str.maketrans({'\\': r'\\', ':': r'\:', '=': r'\=', '|': r'\|',
+                              '\t': r'\t', '\r': r'\r', '\n': r'\n', '\f': r'\f'})
+# a space in a key would end it, as in java.util.Properties
+ESCAPE_KEY_TABLE = str.maketrans({'\\': r'\\', ':': r'\:', '=': r'\=', '|': r'\|', ' ': r'\ ',
+                                  '\t': r'\t', '\r': r'\r', '\n': r'\n', '\f': r'\f'})
 
 
 # Errors ######################################################################
@@ -24,43 +33,47 @@ class PropertiesError(Exception):
     pass
 
 
+# Utilities ###################################################################
+###############################################################################
+def _unescape_char(m):
+    c = m.group(1)
+    if len(c) == 5:
+        return chr(int(c[1:], 16))
+    if c == 'u':
+        raise PropertiesError('Malformed \\uxxxx encoding.')
+    return ESCAPES.get(c, c)
+
+
+@lru_cache(maxsize=4096)
+def _unescape(value):
+    return RE_ESCAPE.sub(_unescape_char, value)
+
+
 # Properties ##################################################################
 ###############################################################################
 class Properties:
-    re_property = re.compile(r'(.+?)(?<!\\)(?:\s*[=|:]\s*)(.*)')
-    re_property_space = re.compile(r'(.+?)(?<!\\)(?:[ ]+)(.+)')
+    # a key is plain characters and escape pairs, so a separator after an escaped backslash still counts
+    re_property = re.compile(r'((?:[^\\]|\\.)+?)(?:\s*[=|:]\s*)(.*)')
+    re_property_space = re.compile(r'((?:[^\\]|\\.)+?)(?:[ ]+)(.+)')
     re_tail = re.compile(r'([\\]+)$')
+    re_separator = re.compile(r'\s*[=|:]\s*')
+
+    @staticmethod
+    def escape(value, key=False):
+        value = value.translate(ESCAPE_KEY_TABLE if key else ESCAPE_TABLE)
+        # load drops leading whitespace, and a line starting with # or ! is a comment
+        if value.startswith(('#', '!') if key else ' '):
+            value = '\\' + value
+        return value
 
-    # shamed copy from "jproperties"
     @staticmethod
     def unescape(value):
-        ret = []
-        backslash = False
-        for c in value:
-            if backslash:
-                if c == "u":
-                    # fall through to native unicode_escape
-                    ret.append(r"\u")
-                elif c == "t":
-                    ret.append("\t")
-                elif c == "r":
-                    ret.append("\r")
-                elif c == "n":
-                    ret.append("\n")
-                elif c == "f":
-                    ret.append("\f")
-                else:
-                    ret.append(c)
-                backslash = False
-            elif c == "\\":
-                backslash = True
-            else:
-                ret.append(c)
-        ret = "".join(ret).encode("utf-8").decode("unicode_escape")
-        return ret
+        if '\\' not in value:
+            return value
+        return _unescape(value)
 
     def __init__(self, defaults=None):
-        self._props = OrderedDict()
+        self._props = {}
         if defaults is not None:
             if isinstance(defaults, abc.Mapping):
                 self._props.update(defaults)
@@ -76,11 +89,12 @@ class Properties:
         return self.getProperty(key)
 
     def __getattr__(self, name):
+        # only reached after normal lookup failed, so delegate straight to _props;
+        # going through __dict__ keeps this safe before __init__ has run
         try:
-            return self.__dict__[name]
-        except KeyError:
-            if hasattr(self._props, name):
-                return getattr(self._props, name)
+            return getattr(self.__dict__['_props'], name)
+        except (KeyError, AttributeError):
+            raise AttributeError(name) from None
 
     def __len__(self):
         return len(self._props)
@@ -95,12 +109,7 @@ class Properties:
         del self._props[key]
 
     def __str__(self):
-        s = '{'
-        for key, value in self._props.items():
-            s = ''.join((s, key, '=', value, ', '))
-
-        s = ''.join((s[:-2], '}'))
-        return s
+        return ''.join(('{', ', '.join(f'{key}={value}' for key, value in self._props.items()), '}'))
 
     def __iter__(self):
         return iter(self._props)
@@ -124,30 +133,34 @@ class Properties:
     def stringPropertyNames(self):
         return set(self._props.keys())
 
+    def _split(self, line: str):
+        if '\\' not in line:
+            # nothing is escaped, so the first separator ends the key
+            m = self.re_separator.search(line, 1)
+            if m:
+                return line[:m.start()], line[m.end():]
+            key, _, value = line.partition(' ')
+            value = value.lstrip(' ')
+            return (key, value) if value else None
+        m = self.re_property.match(line) or self.re_property_space.match(line)
+        return m.groups() if m else None
+
     def load(self, ins: typing.IO):
         lineno = 0
-        lines = iter(ins.readlines())
+        lines = iter(ins)
         for line in lines:
             lineno += 1
-            line = line.strip()
+            # only leading whitespace is insignificant, as in java.util.Properties
+            line = line.lstrip().rstrip('\r\n')
             if not line or line.startswith('#') or line.startswith('!'):
                 continue
-            while line.endswith('\\'):
-                if len(self.re_tail.search(line).group(1)) % 2 == 1:
-                    line = line[:-1] + next(lines).strip()
-                    lineno += 1
-            m = self.re_property.match(line)
-            if m:
-                key = m.group(1)
-                value = m.group(2)
-            else:
-                m = self.re_property_space.match(line)
-                if m:
-                    key = m.group(1)
-                    value = m.group(2)
-                else:
-                    raise PropertiesError(f'Illegal property at line: {lineno}')
-            self.setProperty(self.unescape(key), self.unescape(value))
+            while line.endswith('\\') and len(self.re_tail.search(line).group(1)) % 2 == 1:
+                line = line[:-1] + next(lines, '').lstrip().rstrip('\r\n')
+                lineno += 1
+            kv = self._split(line)
+            if kv is None:
+                raise PropertiesError(f'Illegal property at line: {lineno}')
+            self.setProperty(self.unescape(kv[0]), self.unescape(kv[1]))
 
     def store(self, out, comments: str=None):
         lines = []
@@ -155,8 +168,8 @@ class Properties:
             lines.append(''.join(('# ', comments)))
         lines.append(''.join(('# ', time.strftime(DMT, time.gmtime()))))
         for k, v in self._props.items():
-            lines.append(f'{k}={v}')
+            lines.append(f'{self.escape(k, key=True)}={self.escape(v)}')
         if 'b' in out.mode:
-            out.write('\n'.encode(ENCODING).join([s.encode(ENCODING) for s in lines]))
+            out.write('\n'.join(lines).encode(ENCODING))
         else:
             out.write('\n'.join(lines))
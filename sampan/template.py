@@ -164,14 +164,22 @@ if you need to include a literal ``{{``, ``{%``, or ``{#`` in the output.
     ``{% continue %}`` may be used inside the loop.
 """
 import datetime
+import hashlib
+import importlib.util
 import linecache
+import marshal
 import os
 import re
 import json
+import struct
+import tempfile
 import threading
-from io import StringIO
+import types
+import weakref
 from html import escape
+from stat import S_ISDIR
 from urllib.parse import quote
+from . import __version__
 from .log import get_logger
 
 
@@ -181,6 +189,23 @@ __all__ = ['Template', 'TemplateError', 'StringLoader', 'FileLoader']
 log = get_logger(__name__)
 DEFAULT_AUTO_ESCAPE = 'html_escape'
 DEFAULT_STRING_NAME = '<string>'
+# bumped whenever the generated code changes shape (helper names, _tt_execute's signature)
+CODEGEN_VERSION = 1
+# marshal data is only valid for the interpreter and the code generator that wrote it
+CACHE_MAGIC = b''.join((b'STTC', importlib.util.MAGIC_NUMBER, f'{__version__}:{CODEGEN_VERSION}\n'.encode()))
+# '{{', '{%' or '{#'; in a run of curlies the innermost pair starts the token
+RE_DIRECTIVE = re.compile(r'\{(?:[%#]|\{(?!\{))')
+RE_SQUEEZE = re.compile(r'[\x00-\x20]+')
+# intermediate ('else', 'elif', etc) operators and the blocks they may attach to
+INTERMEDIATE_BLOCKS = {
+    'else': frozenset({'if', 'for', 'while', 'try'}),
+    'elif': frozenset({'if'}),
+    'except': frozenset({'try'}),
+    'finally': frozenset({'try'}),
+}
+STATEMENT_OPERATORS = frozenset({'extends', 'include', 'set', 'import', 'from', 'comment', 'auto_escape', 'raw',
+                                 'module'})
+BLOCK_OPERATORS = frozenset({'apply', 'block', 'try', 'if', 'for', 'while'})
 
 
 # Errors ######################################################################
@@ -222,7 +247,26 @@ class ObjectDict(dict):
 
 def squeeze(s):
     """Replace all sequences of whitespace chars with a single space."""
-    return re.sub(r"[\x00-\x20]+", " ", s).strip()
+    return RE_SQUEEZE.sub(' ', s).strip()
+
+
+def _private_dir(path, create=False):
+    """Returns True when ``path`` is a directory owned by the current user
+    that nobody else can write to, creating it with mode 0o700 if asked.
+    Cache files are exec'd, so they are only trusted in such a directory.
+    """
+    if create:
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        except OSError:
+            return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not S_ISDIR(st.st_mode) or st.st_mode & 0o022:
+        return False
+    return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
 
 
 def to_str(_bytes, encoding='utf8'):
@@ -233,24 +277,90 @@ def to_str(_bytes, encoding='utf8'):
     return _bytes.decode(encoding)
 
 
-def json_dumps(obj):
-    return json.dumps(obj)
+json_dumps = json.dumps
+
+
+def expression_str(value, escape_fn=None):
+    """Converts the value of a ``{{ }}`` expression to str and escapes it."""
+    if isinstance(value, bytes):
+        value = value.decode('utf8')
+    elif not isinstance(value, str):
+        value = str(value)
+    if escape_fn is None:
+        return value
+    if escape_fn is escape:
+        # the default escape returns str, and most values have nothing to escape
+        if '&' in value or '<' in value or '>' in value or '"' in value or "'" in value:
+            return escape(value)
+        return value
+    return to_str(escape_fn(value))
 
 
 # Template ####################################################################
 ###############################################################################
 class Template:
-    def __init__(self, template_string, name=DEFAULT_STRING_NAME, loader=None, auto_escape=DEFAULT_AUTO_ESCAPE):
+    def __init__(self, template_string, name=DEFAULT_STRING_NAME, loader=None, auto_escape=DEFAULT_AUTO_ESCAPE,
+                 debug=False):
         self.name = name
+        # debug keeps the template file:line comments in the generated code
+        self.debug = loader.debug if loader else debug
         if loader and loader.auto_escape:
             self.auto_escape = loader.auto_escape
         else:
             self.auto_escape = auto_escape
         self.namespace = loader.namespace if loader else {}
-        self.file = _File(self, _parse(self, _TemplateReader(to_str(template_string))))
-        self.code = self._generate_python(loader)
+        self.template_string = template_string
+        self.dependencies = []
+        self._ancestors = None
+        self._file = _File(self, _parse(self, to_str(template_string))[0])
         self.loader = loader
-        self.compiled = compile(self.code, '{}.gen.py'.format(self.name.replace('.', '_')), 'exec', dont_inherit=True)
+        # generated and compiled on first use; templates that are only ever
+        # extended or included never need their own code
+        self._code = None
+        self._compiled = None
+        self._base_namespace = self._build_namespace()
+
+    @classmethod
+    def _from_compiled(cls, template_string, name, loader, auto_escape, dependencies, code, compiled):
+        """Rebuilds a template from a previous compilation without parsing it.
+        The parse tree is only built if another template extends or includes
+        this one.
+        """
+        template = cls.__new__(cls)
+        template.name = name
+        template.auto_escape = auto_escape
+        template.debug = loader.debug if loader else False
+        template.namespace = loader.namespace if loader else {}
+        template.template_string = template_string
+        template.dependencies = list(dependencies)
+        template._ancestors = None
+        template._file = None
+        template.loader = loader
+        template._code = code
+        template._compiled = compiled
+        template._base_namespace = template._build_namespace()
+        return template
+
+    @property
+    def code(self):
+        if self._code is None:
+            self._code = self._generate_python(self.loader)
+        return self._code
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            self._compiled = compile(self.code, '{}.gen.py'.format(self.name.replace('.', '_')), 'exec',
+                                     dont_inherit=True)
+            if self.loader is not None:
+                self.loader.on_compile(self)
+        return self._compiled
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = _File(self, _parse(self, to_str(self.template_string))[0])
+        return self._file
 
     @staticmethod
     def exec_in(code, glob, loc=None):
@@ -258,7 +368,7 @@ class Template:
             code = compile(code, '<string>', 'exec', dont_inherit=True)
         exec(code, glob, loc)
 
-    def generate(self, **kwargs):
+    def _build_namespace(self):
         namespace = {
             'escape': escape,
             'html_escape': escape,
@@ -268,51 +378,68 @@ class Template:
             'datetime': datetime,
             '_tt_utf8': to_str,  # for internal use
             '_tt_string_types': (str, bytes),
+            '_tt_expr': expression_str,
             # __name__ and __loader__ allow the traceback mechanism to find
             # the generated source code.
             '__name__': self.name.replace('.', '_'),
-            '__loader__': ObjectDict(get_source=lambda name: self.code),
+            '__loader__': types.SimpleNamespace(get_source=lambda name: self.code),
         }
         namespace.update(self.namespace)
+        return namespace
+
+    def generate(self, **kwargs):
+        compiled = self._compiled or self.compiled
+        namespace = dict(self._base_namespace)
         namespace.update(kwargs)
-        self.exec_in(self.compiled, namespace)
+        exec(compiled, namespace)
         execute = namespace['_tt_execute']
-        # Clear the traceback module's cache of source data now that
-        # we've generated a new template (mainly for this module's
-        # unittests, where different tests reuse the same name).
-        linecache.clearcache()
-        return execute()
+        try:
+            return execute()
+        except Exception:
+            # Drop any source the traceback module cached for this file name
+            # (templates may share a name) so it is read from __loader__ again.
+            linecache.cache.pop(compiled.co_filename, None)
+            raise
 
     def _generate_python(self, loader):
-        buffer = StringIO()
+        # named_blocks maps from names to _NamedBlock objects
+        named_blocks = {}
+        ancestors = self._get_ancestors(loader)
+        ancestors.reverse()
+        writer = _CodeWriter(named_blocks, loader, ancestors[0].template, self.debug)
         try:
-            # named_blocks maps from names to _NamedBlock objects
-            named_blocks = {}
-            ancestors = self._get_ancestors(loader)
-            ancestors.reverse()
             for ancestor in ancestors:
                 ancestor.find_named_blocks(loader, named_blocks)
-            writer = _CodeWriter(buffer, named_blocks, loader,
-                                 ancestors[0].template)
             ancestors[0].generate(writer)
-            return buffer.getvalue()
-        finally:
-            buffer.close()
-
-    def _get_ancestors(self, loader):
+        except RecursionError:
+            raise TemplateError('circular {% include %} in ' + self.name) from None
+        self.dependencies = [ancestor.template.name for ancestor in ancestors[:-1]] + writer.includes
+        return writer.getvalue()
+
+    def _get_ancestors(self, loader, chain=()):
+        # a parent's chain is the same for every child, so it is walked once per loader
+        if self._ancestors is not None and self._ancestors[0] is loader:
+            return list(self._ancestors[1])
+        if self.name in chain:
+            raise TemplateError('circular {% extends %} through ' + ', '.join(chain + (self.name,)))
         ancestors = [self.file]
         for chunk in self.file.body.chunks:
             if isinstance(chunk, _ExtendsBlock):
                 if not loader:
                     raise TemplateError('{% extends %} block found, but no template loader')
                 template = loader.load(chunk.name, self.name)
-                ancestors.extend(template._get_ancestors(loader))
-        return ancestors
+                ancestors.extend(template._get_ancestors(loader, chain + (self.name,)))
+        self._ancestors = (loader, ancestors)
+        return list(ancestors)
 
 
 ###############################################################################
 # Loaders #####################################################################
 ###############################################################################
+# compiled templates shared by all loaders, see BaseLoader._load_shared
+_SHARED_TEMPLATES = weakref.WeakValueDictionary()
+
+
 class BaseLoader:
     """Base class for template loaders.
       You must use a template loader to use template constructs like
@@ -320,9 +447,10 @@ class BaseLoader:
       templates after they are loaded the first time.
     """
 
-    def __init__(self, namespace=None, auto_escape=DEFAULT_AUTO_ESCAPE):
+    def __init__(self, namespace=None, auto_escape=DEFAULT_AUTO_ESCAPE, debug=False):
         self.namespace = namespace or {}
         self.auto_escape = auto_escape
+        self.debug = debug
         self.templates = dict()
         self.lock = threading.RLock()
 
@@ -331,43 +459,173 @@ class BaseLoader:
         with self.lock:
             self.templates.clear()
 
-    def load(self, obj):
+    def load(self, name, parent_name=None):
         raise NotImplementedError()
 
+    def on_compile(self, template):
+        """Called once a template loaded by this loader has been compiled."""
+        self._share(template)
+
+    def _share(self, template):
+        # code that pulls in no other template depends only on its own source
+        if not template.dependencies:
+            _SHARED_TEMPLATES[self._shared_key(template.name, template.template_string)] = template
+
+    def _shared_key(self, name, template_string):
+        return (name, hashlib.blake2b(template_string if isinstance(template_string, bytes)
+                                      else template_string.encode('utf8'), digest_size=16).digest(),
+                self.auto_escape, self.debug)
+
+    def _load_shared(self, name, template_string):
+        """Reuses the compiled code of an identical template from another loader."""
+        shared = _SHARED_TEMPLATES.get(self._shared_key(name, template_string))
+        if shared is None:
+            return None
+        return Template._from_compiled(template_string, name, self, shared.auto_escape, [],
+                                       shared._code, shared._compiled)
+
 
 class StringLoader(BaseLoader):
     def __init__(self, name=DEFAULT_STRING_NAME, **kwargs):
         super(StringLoader, self).__init__(**kwargs)
         self.name = name
 
-    def load(self, template_string):
+    def load(self, template_string, parent_name=None):
         if not template_string:
             msg = 'template_string is missing.'
             raise Exception(msg)
-        if self.name not in self.templates:
+        template = self.templates.get(self.name)
+        if template is None:
             with self.lock:
-                self.templates[self.name] = Template(template_string, self.name, loader=self)
-        return self.templates[self.name]
+                template = self.templates.get(self.name)
+                if template is None:
+                    template = self._load_shared(self.name, template_string) or \
+                        Template(template_string, self.name, loader=self)
+                    self.templates[self.name] = template
+        return template
 
 
 class FileLoader(BaseLoader):
-    def __init__(self, base_dir=None, **kwargs):
+    """Loads templates from ``base_dir``.
+      If ``cache_dir`` is given, compiled templates are also written there so
+      that a new process can skip parsing and compiling unchanged files. The
+      directory is created private, and is not used unless it is owned by the
+      current user and writable by nobody else.
+    """
+
+    def __init__(self, base_dir=None, cache_dir=None, **kwargs):
         super(FileLoader, self).__init__(**kwargs)
         if base_dir:
             self.base_dir = os.path.abspath(base_dir)
         else:
             self.base_dir = os.path.abspath(os.path.dirname(__file__))
+        self.cache_dir = cache_dir
+        # file path and stat of templates that were parsed but not compiled yet
+        self.sources = {}
 
-    def load(self, name):
+    def resolve_path(self, name, parent_name=None):
+        """Resolves ``name`` relative to the directory of ``parent_name``,
+        as long as the result stays inside ``base_dir``.
+        """
+        if parent_name and not parent_name.startswith('<') and not os.path.isabs(parent_name) \
+                and not os.path.isabs(name):
+            file_dir = os.path.dirname(os.path.join(self.base_dir, parent_name))
+            relative_path = os.path.abspath(os.path.join(file_dir, name))
+            if relative_path.startswith(self.base_dir + os.sep):
+                name = relative_path[len(self.base_dir) + 1:]
+        return name
+
+    def load(self, name, parent_name=None):
         if not name:
             msg = 'name is missing.'
             raise Exception(msg)
-        if name not in self.templates:
+        name = self.resolve_path(name, parent_name)
+        template = self.templates.get(name)
+        if template is None:
             with self.lock:
-                file_path = os.path.abspath(os.path.join(self.base_dir, name))
-                with open(file_path, 'rb') as f:
-                    self.templates[name] = Template(f.read(), name, loader=self)
-        return self.templates[name]
+                template = self.templates.get(name)
+                if template is None:
+                    template = self.templates[name] = self._load_template(name)
+        return template
+
+    def reset(self):
+        with self.lock:
+            self.templates.clear()
+            self.sources.clear()
+
+    def on_compile(self, template):
+        super(FileLoader, self).on_compile(template)
+        source = self.sources.pop(template.name, None)
+        if source is not None:
+            self._write_cache(source[0], source[1], template)
+
+    def _load_template(self, name):
+        file_path = os.path.abspath(os.path.join(self.base_dir, name))
+        with open(file_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            template_string = f.read()
+        template = self._load_shared(name, template_string)
+        if template is None:
+            template = self._read_cache(name, file_path, stat, template_string)
+            if template is not None:
+                self._share(template)
+        if template is None:
+            template = Template(template_string, name, loader=self)
+            self.sources[name] = (file_path, stat)
+        return template
+
+    def _get_cache_path(self, file_path):
+        digest = hashlib.blake2b(file_path.encode('utf8'), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.tpyc')
+
+    def _read_cache(self, name, file_path, stat, template_string):
+        if not self.cache_dir or not _private_dir(self.cache_dir):
+            return None
+        try:
+            with open(self._get_cache_path(file_path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        header = len(CACHE_MAGIC) + 16
+        if data[:len(CACHE_MAGIC)] != CACHE_MAGIC or len(data) < header:
+            return None
+        if struct.unpack_from('<QQ', data, len(CACHE_MAGIC)) != (stat.st_mtime_ns, stat.st_size):
+            return None
+        try:
+            settings, auto_escape, dependencies, code, compiled = marshal.loads(data[header:])
+        except (EOFError, ValueError, TypeError):
+            return None
+        if settings != (self.auto_escape, self.debug):
+            return None
+        # extended and included templates are compiled in, they must be unchanged too
+        for _, dep_path, dep_mtime, dep_size in dependencies:
+            try:
+                dep_stat = os.stat(dep_path)
+            except OSError:
+                return None
+            if (dep_stat.st_mtime_ns, dep_stat.st_size) != (dep_mtime, dep_size):
+                return None
+        return Template._from_compiled(template_string, name, self, auto_escape,
+                                       [dep[0] for dep in dependencies], code, compiled)
+
+    def _write_cache(self, file_path, stat, template):
+        if not self.cache_dir or not _private_dir(self.cache_dir, create=True):
+            return
+        try:
+            dependencies = []
+            for dep in template.dependencies:
+                dep_path = os.path.abspath(os.path.join(self.base_dir, dep))
+                dep_stat = os.stat(dep_path)
+                dependencies.append((dep, dep_path, dep_stat.st_mtime_ns, dep_stat.st_size))
+            data = b''.join((CACHE_MAGIC, struct.pack('<QQ', stat.st_mtime_ns, stat.st_size),
+                             marshal.dumps(((self.auto_escape, self.debug), template.auto_escape, tuple(dependencies),
+                                            template.code, template.compiled))))
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as f:
+                f.write(data)
+            os.replace(f.name, self._get_cache_path(file_path))
+        except OSError:
+            # the cache is an optimization only
+            pass
 
 
 ###############################################################################
@@ -392,12 +650,14 @@ class _File(_Node):
         self.line = 0
 
     def generate(self, writer):
-        writer.write_line('def _tt_execute():', self.line)
+        # the helper is bound as a default so the render loop reads a fast local
+        writer.write_line('def _tt_execute(_tt_expr=_tt_expr):', self.line)
         with writer.indent():
+            # list.append + join measures faster than io.StringIO.write + getvalue
             writer.write_line('_tt_buffer = []', self.line)
             writer.write_line('_tt_append = _tt_buffer.append', self.line)
             self.body.generate(writer)
-            writer.write_line("return _tt_utf8('').join(_tt_buffer)", self.line)
+            writer.write_line("return ''.join(_tt_buffer)", self.line)
 
     def each_child(self):
         return self.body,
@@ -407,6 +667,15 @@ class _ChunkList(_Node):
     def __init__(self, chunks):
         self.chunks = chunks
 
+    def append_text(self, value, line):
+        # adjacent text (split by comments or escaped braces) becomes one append
+        if self.chunks and type(self.chunks[-1]) is _Text:
+            last = self.chunks[-1]
+            last.value += value
+            last.line = line
+        else:
+            self.chunks.append(_Text(value, line))
+
     def generate(self, writer):
         for chunk in self.chunks:
             chunk.generate(writer)
@@ -461,6 +730,7 @@ class _IncludeBlock(_Node):
 
     def generate(self, writer):
         included = writer.loader.load(self.name, self.template_name)
+        writer.includes.append(included.name)
         with writer.include(included, self.line):
             included.file.body.generate(writer)
 
@@ -475,6 +745,11 @@ class _ApplyBlock(_Node):
         return self.body,
 
     def generate(self, writer):
+        if all(type(chunk) is _Text for chunk in self.body.chunks):
+            # static body: apply the method to the literal, no inner function needed
+            value = ''.join(chunk.value for chunk in self.body.chunks)
+            writer.write_line('_tt_append(_tt_utf8(%s(%r)))' % (self.method, value), self.line)
+            return
         method_name = '_tt_apply%d' % writer.apply_counter
         writer.apply_counter += 1
         writer.write_line('def %s():' % method_name, self.line)
@@ -482,7 +757,7 @@ class _ApplyBlock(_Node):
             writer.write_line('_tt_buffer = []', self.line)
             writer.write_line('_tt_append = _tt_buffer.append', self.line)
             self.body.generate(writer)
-            writer.write_line("return _tt_utf8('').join(_tt_buffer)", self.line)
+            writer.write_line("return ''.join(_tt_buffer)", self.line)
         writer.write_line('_tt_append(_tt_utf8(%s(%s())))' % (
             self.method, method_name), self.line)
 
@@ -498,10 +773,12 @@ class _ControlBlock(_Node):
 
     def generate(self, writer):
         writer.write_line('%s:' % self.statement, self.line)
+        writer.block_start = len(writer.lines)
         with writer.indent():
             self.body.generate(writer)
             # Just in case the body was empty
-            writer.write_line('pass', self.line)
+            if len(writer.lines) == writer.block_start:
+                writer.write_line('pass', self.line)
 
 
 class _IntermediateControlBlock(_Node):
@@ -511,8 +788,10 @@ class _IntermediateControlBlock(_Node):
 
     def generate(self, writer):
         # In case the previous block was empty
-        writer.write_line('pass', self.line)
+        if len(writer.lines) == writer.block_start:
+            writer.write_line('pass', self.line)
         writer.write_line('%s:' % self.statement, self.line, writer.indent_size() - 1)
+        writer.block_start = len(writer.lines)
 
 
 class _Statement(_Node):
@@ -531,16 +810,11 @@ class _Expression(_Node):
         self.raw = raw
 
     def generate(self, writer):
-        writer.write_line('_tt_tmp = %s' % self.expression, self.line)
-        writer.write_line('if isinstance(_tt_tmp, _tt_string_types):'
-                          ' _tt_tmp = _tt_utf8(_tt_tmp)', self.line)
-        writer.write_line('else: _tt_tmp = _tt_utf8(str(_tt_tmp))', self.line)
         if not self.raw and writer.current_template.auto_escape is not None:
-            # In python3 functions like html_escape return unicode,
-            # so we have to convert to utf8 again.
-            writer.write_line('_tt_tmp = _tt_utf8(%s(_tt_tmp))' %
-                              writer.current_template.auto_escape, self.line)
-        writer.write_line('_tt_append(_tt_tmp)', self.line)
+            writer.write_line('_tt_append(_tt_expr((%s), %s))' %
+                              (self.expression, writer.current_template.auto_escape), self.line)
+        else:
+            writer.write_line('_tt_append(_tt_expr((%s)))' % self.expression, self.line)
 
 
 class _Module(_Expression):
@@ -560,235 +834,204 @@ class _Text(_Node):
             writer.write_line('_tt_append(%r)' % to_str(value), self.line)
 
 
+class _Indenter(object):
+    __slots__ = ('writer',)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __enter__(self):
+        self.writer._indent += 1
+        return self.writer
+
+    def __exit__(self, *args):
+        assert self.writer._indent > 0
+        self.writer._indent -= 1
+
+
+class _IncludeTemplate(object):
+    __slots__ = ('writer',)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __enter__(self):
+        return self.writer
+
+    def __exit__(self, *args):
+        self.writer.current_template = self.writer.include_stack.pop()[0]
+        self.writer.update_via()
+
+
 class _CodeWriter(object):
-    def __init__(self, file, named_blocks, loader, current_template):
-        self.file = file
+    def __init__(self, named_blocks, loader, current_template, debug=False):
+        self.lines = []
+        self.debug = debug
+        self.via = ''
+        # number of lines written when the innermost control block last opened a suite
+        self.block_start = -1
         self.named_blocks = named_blocks
         self.loader = loader
         self.current_template = current_template
         self.apply_counter = 0
         self.include_stack = []
+        self.includes = []
         self._indent = 0
+        # the context managers hold no state of their own, so one of each is reused
+        self._indenter = _Indenter(self)
+        self._include_template = _IncludeTemplate(self)
 
     def indent_size(self):
         return self._indent
 
     def indent(self):
-        class Indenter(object):
-            def __enter__(_):
-                self._indent += 1
-                return self
-
-            def __exit__(_, *args):
-                assert self._indent > 0
-                self._indent -= 1
-
-        return Indenter()
+        return self._indenter
 
     def include(self, template, line):
         self.include_stack.append((self.current_template, line))
         self.current_template = template
-
-        class IncludeTemplate(object):
-            def __enter__(_):
-                return self
-
-            def __exit__(_, *args):
-                self.current_template = self.include_stack.pop()[0]
-
-        return IncludeTemplate()
+        self.update_via()
+        return self._include_template
+
+    def update_via(self):
+        # built once per include instead of for every line written inside it
+        if self.debug and self.include_stack:
+            ancestors = ['%s:%d' % (tmpl.name, lineno) for (tmpl, lineno) in self.include_stack]
+            self.via = ' (via %s)' % ', '.join(reversed(ancestors))
+        else:
+            self.via = ''
 
     def write_line(self, line, line_number, indent=None):
         if indent is None:
             indent = self._indent
-        line_comment = '  # %s:%d' % (self.current_template.name, line_number)
-        if self.include_stack:
-            ancestors = ['%s:%d' % (tmpl.name, lineno)
-                         for (tmpl, lineno) in self.include_stack]
-            line_comment += ' (via %s)' % ', '.join(reversed(ancestors))
-        print('    ' * indent + line + line_comment, file=self.file)
-
-
-class _TemplateReader:
-    def __init__(self, text):
-        self.text = text
-        self.line = 1
-        self.pos = 0
-
-    def find(self, needle, start=0, end=None):
-        start += self.pos
-        if end is None:
-            index = self.text.find(needle, start)
-        else:
-            end += self.pos
-            assert end >= start
-            index = self.text.find(needle, start, end)
-        if index != -1:
-            index -= self.pos
-        return index
-
-    def consume(self, count=None):
-        if count is None:
-            count = len(self.text) - self.pos
-        new_pos = self.pos + count
-        self.line += self.text.count('\n', self.pos, new_pos)
-        s = self.text[self.pos:new_pos]
-        self.pos = new_pos
-        return s
-
-    def remaining(self):
-        return len(self.text) - self.pos
-
-    def __len__(self):
-        return self.remaining()
+        if not self.debug:
+            self.lines.append('    ' * indent + line)
+            return
+        line_comment = '  # %s:%d%s' % (self.current_template.name, line_number, self.via)
+        self.lines.append('    ' * indent + line + line_comment)
 
-    def __str__(self):
-        return self.text[self.pos:]
-
-    def __getitem__(self, key):
-        if type(key) is slice:
-            size = len(self)
-            start, stop, step = key.indices(size)
-            if start is None:
-                start = self.pos
-            else:
-                start += self.pos
-            if stop is not None:
-                stop += self.pos
-            return self.text[slice(start, stop, step)]
-        elif key < 0:
-            return self.text[key]
-        else:
-            return self.text[self.pos + key]
+    def getvalue(self):
+        return '\n'.join(self.lines) + '\n'
 
 
 ###############################################################################
 # Parser ######################################################################
 ###############################################################################
-def _parse(template, reader, in_block=None, in_loop=None):
+def _parse(template, text, pos=0, line=1, in_block=None, in_loop=None):
+    """Parses ``text`` from ``pos`` and returns ``(body, pos, line)``, where
+    ``pos`` and ``line`` point just after the parsed chunks.
+    """
     body = _ChunkList([])
+    size = len(text)
+    search = RE_DIRECTIVE.search
     while True:
         # Find next template directive
-        curly = 0
-        while True:
-            curly = reader.find('{', curly)
-            if curly == -1 or curly + 1 == reader.remaining():
-                # EOF
-                if in_block:
-                    msg = 'Missing end block for {}'.format(in_block)
-                    raise TemplateError(msg, template.name, reader.line)
-                body.chunks.append(_Text(reader.consume(), reader.line))
-                return body
-            # If the first curly brace is not the start of a special token,
-            # start searching from the character after it
-            if reader[curly + 1] not in ('{', '%', '#'):
-                curly += 1
-                continue
-            # When there are more than 2 curlies in a row, use the
-            # innermost ones.  This is useful when generating languages
-            # like latex where curlies are also meaningful
-            if curly + 2 < reader.remaining() and reader[curly + 1] == '{' and reader[curly + 2] == '{':
-                curly += 1
-                continue
-            break
+        m = search(text, pos)
+        if m is None:
+            # EOF
+            if in_block:
+                msg = 'Missing end block for {}'.format(in_block)
+                raise TemplateError(msg, template.name, line)
+            line += text.count('\n', pos)
+            body.append_text(text[pos:], line)
+            return body, size, line
+        curly = m.start()
 
         # Append any text before the special token
-        if curly > 0:
-            cons = reader.consume(curly)
-            body.chunks.append(_Text(cons, reader.line))
+        if curly > pos:
+            line += text.count('\n', pos, curly)
+            body.append_text(text[pos:curly], line)
 
-        start_brace = reader.consume(2)
-        line = reader.line
+        start_brace = m.group()
+        pos = m.end()
+        start_line = line
 
         # Template directives may be escaped as '{{!' or '{%!'.
         # In this case output the braces and consume the '!'.
         # This is especially useful in conjunction with jquery templates,
         # which also use double braces.
-        if reader.remaining() and reader[0] == '!':
-            reader.consume(1)
-            body.chunks.append(_Text(start_brace, line))
+        if text.startswith('!', pos):
+            pos += 1
+            body.append_text(start_brace, start_line)
             continue
 
         # Comment
         if start_brace == '{#':
-            end = reader.find('#}')
+            end = text.find('#}', pos)
             if end == -1:
-                raise TemplateError('Missing end comment #}', template.name, reader.line)
-            _ = reader.consume(end).strip()
-            reader.consume(2)
+                raise TemplateError('Missing end comment #}', template.name, line)
+            line += text.count('\n', pos, end)
+            pos = end + 2
             continue
 
         # Expression
         if start_brace == '{{':
-            end = reader.find('}}')
+            end = text.find('}}', pos)
             if end == -1:
-                raise TemplateError('Missing end expression }}', template.name, reader.line)
-            contents = reader.consume(end).strip()
-            reader.consume(2)
+                raise TemplateError('Missing end expression }}', template.name, line)
+            contents = text[pos:end]
+            line += contents.count('\n')
+            contents = contents.strip()
+            pos = end + 2
             if not contents:
-                raise TemplateError('Empty expression', template.name, reader.line)
-            body.chunks.append(_Expression(contents, line))
+                raise TemplateError('Empty expression', template.name, line)
+            body.chunks.append(_Expression(contents, start_line))
             continue
 
         # Block
         assert start_brace == '{%', start_brace
-        end = reader.find('%}')
+        end = text.find('%}', pos)
         if end == -1:
-            raise TemplateError('Missing end block %}', template.name, reader.line)
-        contents = reader.consume(end).strip()
-        reader.consume(2)
+            raise TemplateError('Missing end block %}', template.name, line)
+        contents = text[pos:end]
+        line += contents.count('\n')
+        contents = contents.strip()
+        pos = end + 2
         if not contents:
-            raise TemplateError('Empty block tag ({% %})', template.name, reader.line)
+            raise TemplateError('Empty block tag ({% %})', template.name, line)
         operator, space, suffix = contents.partition(' ')
         suffix = suffix.strip()
 
         # Intermediate ('else', 'elif', etc) blocks
-        intermediate_blocks = {
-            'else': {'if', 'for', 'while', 'try'},
-            'elif': {'if'},
-            'except': {'try'},
-            'finally': {'try'},
-        }
-        allowed_parents = intermediate_blocks.get(operator)
+        allowed_parents = INTERMEDIATE_BLOCKS.get(operator)
         if allowed_parents is not None:
             if not in_block:
-                msg = '{} outside {} block'.format(operator, allowed_parents)
-                raise TemplateError(msg, template.name, reader.line)
+                msg = '{} outside {} block'.format(operator, ', '.join(sorted(allowed_parents)))
+                raise TemplateError(msg, template.name, line)
             if in_block not in allowed_parents:
                 msg = '{} block cannot be attached to {} block'.format(operator, in_block)
-                raise TemplateError(msg, template.name, reader.line)
-            body.chunks.append(_IntermediateControlBlock(contents, line))
+                raise TemplateError(msg, template.name, line)
+            body.chunks.append(_IntermediateControlBlock(contents, start_line))
             continue
 
         # End tag
         elif operator == 'end':
             if not in_block:
-                raise TemplateError('Extra {% end %} block', template.name, reader.line)
-            return body
+                raise TemplateError('Extra {% end %} block', template.name, line)
+            return body, pos, line
 
-        elif operator in ('extends', 'include', 'set', 'import', 'from',
-                          'comment', 'auto_escape', 'raw', 'module'):
+        elif operator in STATEMENT_OPERATORS:
             block = None
             if operator == 'comment':
                 continue
             if operator == 'extends':
                 suffix = suffix.strip('"').strip("'")
                 if not suffix:
-                    raise TemplateError('extends missing file path', template.name, reader.line)
+                    raise TemplateError('extends missing file path', template.name, line)
                 block = _ExtendsBlock(suffix)
             elif operator in ('import', 'from'):
                 if not suffix:
-                    raise TemplateError('import missing statement', template.name, reader.line)
-                block = _Statement(contents, line)
+                    raise TemplateError('import missing statement', template.name, line)
+                block = _Statement(contents, start_line)
             elif operator == 'include':
                 suffix = suffix.strip('"').strip("'")
                 if not suffix:
-                    raise TemplateError('include missing file path', template.name, reader.line)
-                block = _IncludeBlock(suffix, template.name, line)
+                    raise TemplateError('include missing file path', template.name, line)
+                block = _IncludeBlock(suffix, template.name, start_line)
             elif operator == 'set':
                 if not suffix:
-                    raise TemplateError('set missing statement', template.name, reader.line)
-                block = _Statement(suffix, line)
+                    raise TemplateError('set missing statement', template.name, line)
+                block = _Statement(suffix, start_line)
             elif operator == 'auto_escape':
                 fn = suffix.strip()
                 if fn == 'None':
@@ -796,41 +1039,41 @@ def _parse(template, reader, in_block=None, in_loop=None):
                 template.auto_escape = fn
                 continue
             elif operator == 'raw':
-                block = _Expression(suffix, line, raw=True)
+                block = _Expression(suffix, start_line, raw=True)
             elif operator == 'module':
-                block = _Module(suffix, line)
+                block = _Module(suffix, start_line)
             body.chunks.append(block)
             continue
 
-        elif operator in ('apply', 'block', 'try', 'if', 'for', 'while'):
+        elif operator in BLOCK_OPERATORS:
             # parse inner body recursively
             if operator in ('for', 'while'):
-                block_body = _parse(template, reader, operator, operator)
+                block_body, pos, line = _parse(template, text, pos, line, operator, operator)
             elif operator == 'apply':
                 # apply creates a nested function so syntactically it's not
                 # in the loop.
-                block_body = _parse(template, reader, operator, None)
+                block_body, pos, line = _parse(template, text, pos, line, operator, None)
             else:
-                block_body = _parse(template, reader, operator, in_loop)
+                block_body, pos, line = _parse(template, text, pos, line, operator, in_loop)
 
             if operator == 'apply':
                 if not suffix:
-                    raise TemplateError('apply missing method name', template.name, reader.line)
-                block = _ApplyBlock(suffix, line, block_body)
+                    raise TemplateError('apply missing method name', template.name, line)
+                block = _ApplyBlock(suffix, start_line, block_body)
             elif operator == 'block':
                 if not suffix:
-                    raise TemplateError('block missing name', template.name, reader.line)
-                block = _NamedBlock(suffix, block_body, template, line)
+                    raise TemplateError('block missing name', template.name, line)
+                block = _NamedBlock(suffix, block_body, template, start_line)
             else:
-                block = _ControlBlock(contents, line, block_body)
+                block = _ControlBlock(contents, start_line, block_body)
             body.chunks.append(block)
             continue
 
         elif operator in ('break', 'continue'):
             if not in_loop:
-                raise TemplateError('{} outside {} block'.format(operator, 'for, while'), template.name, reader.line)
-            body.chunks.append(_Statement(contents, line))
+                raise TemplateError('{} outside {} block'.format(operator, 'for, while'), template.name, line)
+            body.chunks.append(_Statement(contents, start_line))
             continue
 
         else:
-            raise TemplateError('unknown operator: {}'.format(operator), template.name, reader.line)
+            raise TemplateError('unknown operator: {}'.format(operator), template.name, line)
@@ -44,33 +44,54 @@
 import re
 import os
 import typing
+import marshal
+import hashlib
+import tempfile
 import datetime
-import linecache
+import builtins
 import threading
-from io import StringIO
+import importlib.util
+from bisect import bisect_left
+from stat import S_ISDIR
+from functools import lru_cache
+from types import FunctionType
 from html import escape
 from urllib.parse import quote
 from json import dumps
+from . import __version__
 
 __all__ = ['Template', 'TemplateError', 'StringLoader', 'FileLoader']
 
 # Constants ###################################################################
 ###############################################################################
 INDENT = 4
+INDENTS = tuple(' ' * (INDENT * i) for i in range(64))
 ENCODING = 'utf-8'
 STR_NAME = '<string>'
-RE_FLAGS = re.MULTILINE | re.DOTALL
+RE_FLAGS = re.DOTALL
 WS = r'[ \t\n\r]*'
+TAG = ('{', '}')
+TAG_MARKS = ('#', '{', '%')
+# closing sequence for each kind of tag, keyed by the character after the opening brace
+TAG_ENDS = {'#': f'#{TAG[1]}', '{': f'}}{TAG[1]}', '%': f'%{TAG[1]}'}
+WS_CHARS = ' \t\n\r'
+RE_NEWLINE = re.compile('\n')
+# bumped whenever the generated code changes shape (helper names, tt_execute's signature)
+CODEGEN_VERSION = 1
+# marshal data is only valid for the interpreter and the code generator that wrote it
+CACHE_MAGIC = b''.join((b'STNG', importlib.util.MAGIC_NUMBER, f'{__version__}:{CODEGEN_VERSION}\n'.encode()))
 
 
 # Errors ######################################################################
 ###############################################################################
 class TemplateError(Exception):
     @staticmethod
-    def linecol(s: str, pos: int):
-        line = s.count('\n', 0, pos) + 1
-        col = pos + 1 if line == 1 else pos - s.rindex('\n', 0, pos)
-        return str(line), str(col)
+    def linecol(s: str, pos: int, newlines: typing.Sequence[int]=None):
+        if newlines is None:
+            newlines = [m.start() for m in RE_NEWLINE.finditer(s)]
+        line = bisect_left(newlines, pos)
+        col = pos + 1 if line == 0 else pos - newlines[line - 1]
+        return str(line + 1), str(col)
 
     def __init__(self, msg: str):
         self.msg = msg
@@ -85,7 +106,7 @@ class TemplateParseError(TemplateError):
         self.reader = reader
 
     def __str__(self):
-        line, col = self.linecol(self.reader.s, self.reader.pos)
+        line, col = self.linecol(self.reader.s, self.reader.pos, self.reader.newlines())
         return ''.join((self.msg, 'line ', line, ' - ', 'column ', col))
 
 
@@ -99,80 +120,150 @@ def to_str(_bytes, encoding='utf8'):
     return _bytes.decode(encoding)
 
 
+def expression_str(value) -> str:
+    # str is by far the most common value, so it is checked before the bytes branch
+    if value.__class__ is str:
+        return value
+    if isinstance(value, bytes):
+        return value.decode(ENCODING)
+    return str(value)
+
+
+def _unquote(s: str) -> str:
+    if len(s) >= 2 and s[0] in '\'"' and s[-1] == s[0]:
+        return s[1:-1]
+    return s
+
+
+def _private_dir(path: str, create: bool=False) -> bool:
+    # cache files are exec'd, so only a directory no one else can write to is trusted
+    if create:
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        except OSError:
+            return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not S_ISDIR(st.st_mode) or st.st_mode & 0o022:
+        return False
+    return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
+
+
+def squeeze(s: str) -> str:
+    return RE_SQUEEZE.sub(' ', s).strip()
+
+
+# Patterns ####################################################################
+###############################################################################
+RE_OPERATOR = re.compile(r'[a-zA-Z0-9_]+')
+RE_SQUEEZE = re.compile(r'[\x00-\x20]+')
+RE_IF = re.compile(rf'{TAG[0]}%{WS}((?:if|else|elif).*?){WS}%{TAG[1]}', RE_FLAGS)
+
+
 # Template ####################################################################
 ###############################################################################
 class _Reader:
     def __init__(self, s):
         self.s = s
         self.pos = 0
+        self.n = len(s)
+        self._newlines = None
 
-    def match(self, regex, start: int=0, end: int=None):
-        return regex.match(self.s, start + self.pos, len(self.s) if end is None else end + self.pos)
-
-    def consume(self, regex):
-        m = regex.match(self.s, self.pos)
-        if m is not None:
-            self.pos = m.end()
-        return m
+    def newlines(self):
+        # offsets of every line break, only built once an error needs a position
+        if self._newlines is None:
+            self._newlines = [m.start() for m in RE_NEWLINE.finditer(self.s)]
+        return self._newlines
 
     def remain(self):
-        return len(self.s) - self.pos
+        return self.n - self.pos
+
+
+class _Indenter(object):
+    __slots__ = ('writer',)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __enter__(self):
+        self.writer._indent += 1
+        return self.writer
+
+    def __exit__(self, *args):
+        assert self.writer._indent > 0
+        self.writer._indent -= 1
+
+
+class _IncludeTemplate(object):
+    __slots__ = ('writer',)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __enter__(self):
+        return self.writer
+
+    def __exit__(self, *args):
+        self.writer.template, self.writer.autoescape = self.writer.include_stack.pop()
 
 
 class _Writer(object):
-    def __init__(self, template, named_blocks):
-        self.buffer = StringIO()
+    def __init__(self, template, named_blocks, loader=None):
+        self.lines = []
         self.template = template
         self.named_blocks = named_blocks
+        self.loader = loader
+        # {% autoescape %} changes it for the rest of the file being written
+        self.autoescape = template.autoescape
         self.apply_counter = 0
         self.include_stack = []
+        # global names the generated body reads, passed to tt_execute as default arguments
+        self.bindings = {}
         self._indent = 0
 
     def indent_size(self):
         return self._indent
 
     def indent(self):
-        class Indenter(object):
-            def __enter__(_):
-                self._indent += 1
-                return self
-
-            def __exit__(_, *args):
-                assert self._indent > 0
-                self._indent -= 1
-
-        return Indenter()
+        return _Indenter(self)
 
     def include(self, template):
-        self.include_stack.append(self.template)
+        self.include_stack.append((self.template, self.autoescape))
         self.template = template
+        self.autoescape = template.autoescape
+        return _IncludeTemplate(self)
 
-        class IncludeTemplate(object):
-            def __enter__(_):
-                return self
+    def bind(self, name: str) -> str:
+        self.bindings[name] = None
+        return name
 
-            def __exit__(_, *args):
-                self.current_template = self.include_stack.pop()[0]
+    def str_value(self, name: str, escape: str=None) -> str:
+        # the str check is inlined, so only other types pay for the tt_str call
+        value = f'{name} if {name}.__class__ is str else {self.bind("tt_str")}({name})'
+        return f'{self.bind(escape)}({value})' if escape else value
 
-        return IncludeTemplate()
+    def write_str(self, exp: str, escape: str=None):
+        self.write_line(f'tt_tmp = ({exp})')
+        self.write_line(f'tt_append({self.str_value("tt_tmp", escape)})')
 
     def write_line(self, line, indent=None):
         if indent is None:
             indent = self._indent
-        print('    ' * indent + line, file=self.buffer)
+        self.lines.append(INDENTS[indent] + line)
 
     def output(self, filename):
-        print('--------------------')
-        print(self.buffer.getvalue())
-        print('--------------------')
-        return compile(self.buffer.getvalue(), filename, 'exec', dont_inherit=True)
+        # the generated module has no docstrings or asserts to keep
+        return compile('\n'.join(self.lines), filename, 'exec', dont_inherit=True, optimize=2)
 
     def close(self):
-        self.buffer.close()
+        self.lines = []
 
 
 class _Node:
-    tag = ('{', '}')
+    __slots__ = ('template',)
+    tag = TAG
 
     def __init__(self, template):
         self.template = template
@@ -184,27 +275,53 @@ class _Node:
         for child in self.each_child():
             child.find_named_blocks(loader, named_blocks)
 
-    def generate(self):
+    def generate(self, writer):
         raise NotImplementedError
 
 
 class _Body(_Node):
+    __slots__ = ('chunks',)
+
     def __init__(self, chunks, **kwargs):
         super(_Body, self).__init__(**kwargs)
-        if chunks:
-            self.chunks = chunks
-        else:
-            self.chunks = []
+        self.chunks = []
+        for chunk in chunks or ():
+            # comments generate nothing, dropping them lets the text around them fuse into one write
+            if isinstance(chunk, (_Comment, _StatementComment)):
+                continue
+            if isinstance(chunk, _Text) and self.chunks and isinstance(self.chunks[-1], _Text):
+                self.chunks[-1].text += chunk.text
+            else:
+                self.chunks.append(chunk)
+        self._optimize()
+
+    def _optimize(self):
+        # runs of text, expressions and raw output are written with a single f-string append
+        chunks, run = [], []
+        for chunk in self.chunks + [None]:
+            if isinstance(chunk, (_Text, _Expression, _StatementRaw)):
+                run.append(chunk)
+                continue
+            if len(run) > 1:
+                chunks.append(_Fused(chunks=run, template=self.template))
+            else:
+                chunks.extend(run)
+            run = []
+            if chunk is not None:
+                chunks.append(chunk)
+        self.chunks = chunks
 
     def each_child(self):
         return self.chunks
 
-    def generate(self):
+    def generate(self, writer):
         for chunk in self.chunks:
-            chunk.generate()
+            chunk.generate(writer)
 
 
 class _File(_Node):
+    __slots__ = ('body',)
+
     def __init__(self, body: _Body, **kwargs):
         super(_File, self).__init__(**kwargs)
         self.body = body
@@ -212,411 +329,532 @@ class _File(_Node):
     def each_child(self):
         return self.body,
 
-    def generate(self):
-        self.template.writer.write_line('def tt_execute():')
-        with self.template.writer.indent():
-            self.template.writer.write_line('tt_buffer = []')
-            self.body.generate()
-            self.template.writer.write_line("return tt_str('').join(tt_buffer)")
+    def generate(self, writer):
+        header = len(writer.lines)
+        writer.write_line('def tt_execute():')
+        with writer.indent():
+            chunks = self.body.chunks
+            if len(chunks) == 1 and isinstance(chunks[0], _Fused):
+                chunks = chunks[0].chunks
+            if all(isinstance(chunk, (_Text, _Expression, _StatementRaw)) for chunk in chunks):
+                # no control flow, so the whole output is one f-string and needs no buffer
+                writer.write_line(f'return {_Fused(chunks=chunks, template=self.template).value(writer)}')
+            else:
+                # a list of pieces joined once beats StringIO.write here, so only the append is bound
+                writer.write_line('tt_buffer = []')
+                writer.write_line('tt_append = tt_buffer.append')
+                self.body.generate(writer)
+                writer.write_line("return ''.join(tt_buffer)")
+        # helpers the body used become default arguments, so it reads them as locals
+        arguments = ', '.join(f'{name}={name}' for name in writer.bindings)
+        writer.lines[header] = f'{INDENTS[writer.indent_size()]}def tt_execute({arguments}):'
 
 
 class _Text(_Node):
-    regex = re.compile(rf'[^{_Node.tag[0]}]+', RE_FLAGS)
+    __slots__ = ('text',)
 
-    def __init__(self, **kwargs):
+    def __init__(self, text: str, **kwargs):
         super(_Text, self).__init__(**kwargs)
-        self.text = self.template.reader.consume(self.regex).group()
+        self.text = text
+
+    def generate(self, writer):
+        writer.write_line(f'tt_append({repr(to_str(self.text))})')
 
-    def generate(self):
-        self.template.writer.write_line(f'tt_buffer.append({repr(to_str(self.text))})')
+
+class _Fused(_Node):
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks: typing.List[_Node], **kwargs):
+        super(_Fused, self).__init__(**kwargs)
+        self.chunks = chunks
+
+    def generate(self, writer):
+        writer.write_line(f'tt_append({self.value(writer)})')
+
+    def value(self, writer) -> str:
+        escape = writer.autoescape
+        pieces = []
+        for i, chunk in enumerate(self.chunks):
+            if isinstance(chunk, _Text):
+                pieces.append('f' + repr(to_str(chunk.text).replace('{', '{{').replace('}', '}}')))
+            else:
+                # evaluated first, so the f-string itself only reads locals
+                name = f'tt_tmp{i}'
+                writer.write_line(f'{name} = ({chunk.exp})')
+                value = writer.str_value(name, None if isinstance(chunk, _StatementRaw) else escape)
+                pieces.append(f"f'{{{value}}}'")
+        return ' '.join(pieces) or "''"
 
 
 class _Comment(_Node):
+    __slots__ = ()
     tag = (f'{_Node.tag[0]}#', f'#{_Node.tag[1]}')
-    regex = re.compile(rf'{tag[0]}.+?{tag[1]}', RE_FLAGS)
 
     def __init__(self, **kwargs):
         super(_Comment, self).__init__(**kwargs)
-        _ = self.template.reader.consume(self.regex)
 
-    def generate(self):
+    def generate(self, writer):
         pass
 
 
 class _Expression(_Node):
+    __slots__ = ('exp',)
     tag = (f'{_Node.tag[0]}{{', f'}}{_Node.tag[1]}')
-    regex = re.compile(rf'{tag[0]}{WS}(.+?){WS}{tag[1]}')
 
-    def __init__(self, **kwargs):
+    def __init__(self, exp: str, **kwargs):
         super(_Expression, self).__init__(**kwargs)
-        self.exp = self.template.reader.consume(self.regex).group(1)
+        self.exp = exp
     
-    def generate(self):
-        self.template.writer.write_line(f'tt_tmp = {self.exp}')
-        self.template.writer.write_line('if isinstance(tt_tmp, str): tt_tmp = tt_str(tt_tmp)')
-        if self.template.autoescape is not None:
-            self.template.writer.write_line(f'tt_tmp = tt_str({self.template.autoescape}(tt_tmp))')
-        self.template.writer.write_line('tt_buffer.append(tt_tmp)')
+    def generate(self, writer):
+        writer.write_str(self.exp, writer.autoescape)
 
 
 class _Statement(_Node):
+    __slots__ = ()
     tag = (f'{_Node.tag[0]}%', f'%{_Node.tag[1]}')
-    
-    def __init__(self, **kwargs):
+    # True when the generated code depends on the loader
+    dynamic = False
+
+    def __init__(self, arg: str=None, **kwargs):
+        # ``arg`` is the text after the operator, statements that take one pick it up themselves
         super(_Statement, self).__init__(**kwargs)
 
-    def generate(self):
+    def generate(self, writer):
         raise NotImplementedError
 
 
 class _StatementInline(_Statement):
-    regex = re.compile(rf'{_Statement.tag[0]}{WS}([a-zA-Z0-9_]+?{WS}.+?){WS}{_Statement.tag[1]}')
+    __slots__ = ('stat',)
 
-    def __init__(self, **kwargs):
+    def __init__(self, stat: str, **kwargs):
         super(_StatementInline, self).__init__(**kwargs)
-        self.stat = self.template.reader.consume(self.regex).group(1)
+        self.stat = stat
 
-    def generate(self):
-        self.template.writer.write_line(self.stat)
+    def generate(self, writer):
+        writer.write_line(self.stat)
 
 
 class _StatementComment(_StatementInline):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(_StatementComment, self).__init__(**kwargs)
 
-    def generate(self):
+    def generate(self, writer):
         pass
 
 
 class _StatementSet(_StatementInline):
-    def __init__(self, **kwargs):
+    __slots__ = ('exp',)
+
+    def __init__(self, arg: str, **kwargs):
         super(_StatementSet, self).__init__(**kwargs)
-        _, _, self.exp = self.stat.partition(' ')
+        self.exp = arg
 
-    def generate(self):
-        self.template.writer.write_line(self.exp)
+    def generate(self, writer):
+        writer.write_line(self.exp)
 
 
 class _StatementRaw(_StatementInline):
-    def __init__(self, **kwargs):
+    __slots__ = ('exp',)
+
+    def __init__(self, arg: str, **kwargs):
         super(_StatementRaw, self).__init__(**kwargs)
-        _, _, self.exp = self.stat.partition(' ')
+        self.exp = arg
 
-    def generate(self):
-        self.template.writer.write_line(f'tt_tmp = {self.exp}')
-        self.template.writer.write_line('if isinstance(tt_tmp, str): tt_tmp = tt_str(tt_tmp)')
-        self.template.writer.write_line('tt_buffer.append(tt_tmp)')
+    def generate(self, writer):
+        writer.write_str(self.exp)
 
 
 class _StatementAutoescape(_StatementInline):
-    def __init__(self, **kwargs):
+    __slots__ = ('name',)
+    dynamic = True
+
+    def __init__(self, arg: str, **kwargs):
         super(_StatementAutoescape, self).__init__(**kwargs)
-        _, _, self.name = self.stat.partition(' ')
+        self.name = arg
 
-    def generate(self):
+    def generate(self, writer):
         if self.name == 'None':
-            self.template.autoescape = None
+            writer.autoescape = None
         else:
-            _ns = self.template.namespace
-            if self.name not in _ns:
+            if self.name not in self.template.namespace:
                 raise TemplateError(f'Unknown autoescape function "{self.name}".')
-            self.template.autoescape = _ns[self.name]
+            writer.autoescape = self.name
 
 
 class _StatementIf(_Statement):
-    regex = re.compile(rf'{_Statement.tag[0]}{WS}((?:if|else|elif).*?){WS}{_Statement.tag[1]}', RE_FLAGS)
-    regex_end = re.compile(rf'{_Statement.tag[0]}{WS}end{WS}{_Statement.tag[1]}')
+    __slots__ = ('stats',)
+    regex = RE_IF
+    clauses = ('else', 'elif')
 
-    def __init__(self, **kwargs):
+    def __init__(self, stat: str, **kwargs):
         super(_StatementIf, self).__init__(**kwargs)
-        self.stats = {}
-        _m = self.template.reader.consume(self.regex)
-        while _m:
-            self.stats[_m.group(1)] = _Body(chunks=self.template.parser.parse(), template=self.template)
-            _m = self.template.reader.consume(self.regex)
-        else:
-            self.template.reader.consume(self.regex_end)
+        self.stats = self.template.parser.parse_clauses(stat, self.clauses)
 
-    def generate(self):
-        print(self.stats)
-        for cond, stat in self.stats.items():
-            self.template.writer.write_line(f'{cond}:')
-            with self.template.writer.indent():
-                stat.generate()
+    def each_child(self):
+        return [body for _, body in self.stats]
+
+    def generate(self, writer):
+        for cond, stat in self.stats:
+            writer.write_line(f'{cond}:')
+            with writer.indent():
+                if stat.chunks:
+                    stat.generate(writer)
+                else:
+                    writer.write_line('pass')
 
 
 class _StatementLoop(_Statement):
-    regex = re.compile(rf'{_Statement.tag[0]}{WS}((?:for|while){WS}.+?){WS}{_Statement.tag[1]}'
-                       rf'(.+?){_Statement.tag[0]}{WS}end{WS}{_Statement.tag[1]}', RE_FLAGS)
+    __slots__ = ('cond', 'stat')
 
-    def __init__(self, **kwargs):
+    def __init__(self, stat: str, **kwargs):
         super(_StatementLoop, self).__init__(**kwargs)
-        _m = self.template.reader.consume(self.regex)
-        self.cond = _m.group(1)
-        with self.template.parser.in_loop():
-            self.stat = self.template.parser.parse(_m.group(2))
+        (self.cond, self.stat), = self.template.parser.parse_clauses(stat, (), in_loop=True)
+
+    def each_child(self):
+        return self.stat,
 
-    def generate(self):
-        self.template.writer.write_line(f'{self.cond}:')
-        with self.template.writer.indent():
-            self.stat.generate()
+    def generate(self, writer):
+        writer.write_line(f'{self.cond}:')
+        with writer.indent():
+            self.stat.generate(writer)
 
 
 class _StatementTry(_Statement):
-    regex = re.compile(rf'{_Statement.tag[0]}{WS}((?:try|except|else|finally){WS}.+?){WS}{_Statement.tag[1]}'
-                       rf'((?:(?!{_Statement.tag[0]}{WS}(?:except|else|finally|end)).)*)', RE_FLAGS)
+    __slots__ = ('stats',)
+    clauses = ('except', 'else', 'finally')
 
-    def __init__(self, **kwargs):
+    def __init__(self, stat: str, **kwargs):
         super(_StatementTry, self).__init__(**kwargs)
-        self.stats = []
-        _m = self.template.reader.consume(self.regex)
-        while _m is not None:
-            self.stats = (_m.group(1), self.template.parse(_Reader(_m.group(2))))
-            _m = self.template.reader.consume(self.regex)
-        else:
-            self.template.reader.consume(self.regex_end)
+        self.stats = self.template.parser.parse_clauses(stat, self.clauses)
 
-    def generate(self):
+    def each_child(self):
+        return [body for _, body in self.stats]
+
+    def generate(self, writer):
         for stat in self.stats:
-            self.template.writer.write_line(f'{stat[0]}:')
-            with self.template.writer.indent():
-                if stat[1] is not None:
-                    stat[1].generate()
+            writer.write_line(f'{stat[0]}:')
+            with writer.indent():
+                if stat[1].chunks:
+                    stat[1].generate(writer)
                 else:
-                    self.template.writer.write_line('pass')
+                    writer.write_line('pass')
 
 
 class _StatementInclude(_StatementInline):
-    def __init__(self, **kwargs):
+    __slots__ = ('name',)
+    dynamic = True
+
+    def __init__(self, arg: str, **kwargs):
         super(_StatementInclude, self).__init__(**kwargs)
-        _, _, self.name = self.stat.partition(' ')
-        self.name = self.name.strip("'").strip('"')
+        self.name = _unquote(arg)
 
-    def find_blocks(self, loader, named_blocks):
-        included = loader.load(self.name)
-        included.file.find_blocks(loader, named_blocks)
+    def find_named_blocks(self, loader, named_blocks):
+        loader.load(self.name).get_file().find_named_blocks(loader, named_blocks)
 
-    def generate(self):
-        included = self.template.writer.loader.load(self.name)
-        with self.template.writer.include(included):
-            included.file
+    def generate(self, writer):
+        # written inline, so the included body appends to the including template's buffer
+        included = writer.loader.load(self.name)
+        with writer.include(included):
+            included.get_file().body.generate(writer)
 
 
 class _StatementBlock(_Statement):
-    regex = re.compile(rf'{_Statement.tag[0]}{WS}(block{WS}.+?){WS}{_Statement.tag[1]}'
-                       rf'(.+?){_Statement.tag[0]}{WS}end{WS}{_Statement.tag[1]}', RE_FLAGS)
+    __slots__ = ('name', 'block')
+    dynamic = True
 
-    def __init__(self, **kwargs):
+    def __init__(self, stat: str, arg: str, **kwargs):
         super(_StatementBlock, self).__init__(**kwargs)
-        _m = self.template.reader.consume(self.regex)
-        self.name = _m.group(1)
-        self.block = _m.group(2)
+        self.name = arg
+        (_, self.block), = self.template.parser.parse_clauses(stat, ())
 
     def each_child(self):
-        return self.block
+        return self.block,
 
-    def find_blocks(self, loader, named_blocks):
+    def find_named_blocks(self, loader, named_blocks):
         named_blocks[self.name] = self
         _Node.find_named_blocks(self, loader, named_blocks)
 
-    def generate(self):
-        if self.name not in self.template.cache:
-            _buffer = StringIO()
-            _body = self.template.parse(_Reader(self.block), _Writer(_buffer))
-            _body.generate()
-            self.template.cache[self.name] = _buffer.getvalue()
+    def generate(self, writer):
+        # the last template in the extends chain that defines the block wins
+        writer.named_blocks.get(self.name, self).block.generate(writer)
 
 
 class _StatementExtends(_StatementInline):
-    def __init__(self, **kwargs):
+    __slots__ = ('name',)
+    dynamic = True
+
+    def __init__(self, arg: str, **kwargs):
         super(_StatementExtends, self).__init__(**kwargs)
-        _, _, self.name = super(_StatementExtends, self).stat.partition(' ')
-        self.name = self.name.strip("'").strip('"')
-        
-    def each_child(self):
-        return super(_StatementExtends, self).each_child()
-    
-    def find_blocks(self, loader, named_blocks):
-        super(_StatementExtends, self).find_named_blocks(loader, named_blocks)
+        self.name = _unquote(arg)
 
-    def generate(self):
-        if self.name not in self.template.cache:
-            _buffer = StringIO()
-            with open(self.name, mode='r', encoding=ENCODING) as f:
-                _body = self.template.parse(_Reader(f.read()), _Writer(_buffer))
-                _body.generate()
-            self.template.cache[self.name] = _buffer.getvalue()
+    def generate(self, writer):
+        # Template.compile generates the root of the extends chain, never the tag itself
+        pass
 
 
 class _Parser:
-    def __init__(self, template, in_loop=False, in_block=False):
+    statements = {
+        'if': _StatementIf,
+        'for': _StatementLoop,
+        'while': _StatementLoop,
+        'try': _StatementTry,
+        'set': _StatementSet,
+        'raw': _StatementRaw,
+        'import': _StatementInline,
+        'from': _StatementInline,
+        'break': _StatementInline,
+        'continue': _StatementInline,
+        'comment': _StatementComment,
+        'autoescape': _StatementAutoescape,
+        'block': _StatementBlock,
+        'include': _StatementInclude,
+        'extends': _StatementExtends
+    }
+
+    def __init__(self, template, in_loop=False):
         self.template = template
         self._in_loop = in_loop
-        self._in_block = in_block
         self._in_nested = 0
-
-    def in_nested(self):
-        class InNested:
-            def __enter__(_):
-                self._in_nested += 1
-                return self
-
-            def __exit__(_, *args):
-                assert self._in_nested > 0
-                self._in_nested -= 1
-
-        return InNested()
-
-    def in_loop(self):
-        class InLoop:
-            def __enter__(_):
-                self._in_loop = True
-                return self
-
-            def __exit__(_, *args):
-                assert self._in_loop
-                self._in_loop = False
-        return InLoop()
-
-    def in_block(self):
-        class InBlock:
-            def __enter__(_):
-                self._in_block = True
-                return self
-
-            def __exit__(_, *args):
-                assert self._in_block
-                self._in_block = False
-        return InBlock()
+        # False once a tag makes the generated code depend on the loader
+        self.standalone = True
+        # (operator, stat, end) of the tag that stopped the last nested parse, left unconsumed for its block
+        self.stop = None
+
+    def parse_clauses(self, stat: str, clauses: typing.Tuple[str, ...], in_loop: bool=False) -> list:
+        """Parses the bodies of a block whose opening tag ``stat`` was already
+        consumed, returning ``(clause, body)`` pairs up to its ``end``.
+        """
+        reader = self.template.reader
+        stats = []
+        outer_loop = self._in_loop
+        self._in_loop = outer_loop or in_loop
+        self._in_nested += 1
+        try:
+            while True:
+                stats.append((stat, _Body(chunks=self.parse(), template=self.template)))
+                if self.stop is None:
+                    raise TemplateParseError(reader, f'Missing "end" found in {self.template.name}: ')
+                operator, clause, end = self.stop
+                if operator in clauses:
+                    reader.pos = end
+                    stat = clause
+                    continue
+                if operator != 'end':
+                    raise TemplateParseError(reader, f'Incorrect operator "{operator}" position found '
+                                                     f'in {self.template.name}: ')
+                reader.pos = end
+                return stats
+        finally:
+            self._in_nested -= 1
+            self._in_loop = outer_loop
 
     def parse(self) -> typing.List[_Node]:
+        """Parses chunks from the template reader. A nested parse stops in
+        front of ``end`` and intermediate tags, which the enclosing block consumes.
+        """
+        reader = self.template.reader
+        s = reader.s
+        find = s.find
+        n = reader.n
         chunks = []
-        while self.template.reader.remain() > 0:
-            m = self.template.reader.match(self.template.regex_tag)
-            if m:
-                tag = m.group(1)
-                if tag == '#':
-                    chunks.append(_Comment(template=self.template))
-                elif tag == '{':
-                    chunks.append(_Expression(template=self.template))
-                elif tag == '%':
-                    operator = self.template.reader.match(self.template.regex_operator).group(1)
-                    if operator == 'end':
-                        if self._in_nested == 0:
-                            return chunks
-                    if operator in ('import', 'from'):
-                        chunks.append(_StatementInline(template=self.template))
-                    elif operator in ('break', 'continue'):
-                        if not self._in_loop:
-                            raise TemplateParseError(self.template.reader, f'Incorrect operator "{operator}" position found '
-                                                             f'in {self.template.name}: ')
-                        chunks.append(_StatementInline(template=self.template))
-                    elif operator == 'set':
-                        chunks.append(_StatementSet(template=self.template))
-                    elif operator == 'comment':
-                        chunks.append(_StatementComment(template=self.template))
-                    elif operator == 'raw':
-                        chunks.append(_StatementRaw(template=self.template))
-                    elif operator == 'autoescape':
-                        chunks.append(_StatementAutoescape(template=self.template))
-                    elif operator == 'if':
-                        chunks.append(_StatementIf(template=self.template))
-                    elif operator in ('for', 'while'):
-                        chunks.append(_StatementLoop(template=self.template))
-                    elif operator == 'include':
-                        chunks.append(_StatementInclude(template=self.template))
-                    elif operator == 'block':
-                        chunks.append(_StatementBlock(template=self.template))
-                    elif operator == 'extends':
-                        chunks.append(_StatementExtends(template=self.template))
-                    else:
-                        raise TemplateParseError(self.template.reader, f'Unknown operator "{operator}" found in {self.template.name}: ')
-                else:
-                    raise TemplateParseError(self.template.reader, f'Unknown tag "{tag}" found in {self.template.name}: ')
+        while reader.pos < n:
+            # static text runs up to the next '{' that opens a tag, found with str.find
+            start = reader.pos
+            end = find(TAG[0], start)
+            while end >= 0 and s[end + 1:end + 2] not in TAG_MARKS:
+                end = find(TAG[0], end + 1)
+            if end < 0:
+                end = n
+            if end > start:
+                reader.pos = end
+                chunks.append(_Text(text=s[start:end], template=self.template))
+                continue
+            # a tag: its end is the first closing sequence, no regex needed
+            mark = s[start + 1]
+            close = find(TAG_ENDS[mark], start + 2)
+            if close < 0:
+                raise TemplateParseError(reader, f'Unclosed tag found in {self.template.name}: ')
+            end = close + 2
+            if mark == '#':
+                reader.pos = end
+                chunks.append(_Comment(template=self.template))
+                continue
+            stat = s[start + 2:close].strip(WS_CHARS)
+            if mark == TAG[0]:
+                if not stat:
+                    raise TemplateParseError(reader, f'Empty expression found in {self.template.name}: ')
+                reader.pos = end
+                chunks.append(_Expression(exp=stat, template=self.template))
             else:
-                chunks.append(_Text(template=self.template))
+                m = RE_OPERATOR.match(stat)
+                if m is None:
+                    raise TemplateParseError(reader, f'Missing operator found in {self.template.name}: ')
+                operator = m.group()
+                # whatever follows the operator, for the tags that take a single argument
+                arg = stat[m.end():].lstrip(WS_CHARS)
+                if operator in ('end', 'else', 'elif', 'except', 'finally'):
+                    if self._in_nested == 0:
+                        raise TemplateParseError(reader, f'Incorrect operator "{operator}" position found '
+                                                         f'in {self.template.name}: ')
+                    self.stop = (operator, stat, end)
+                    return chunks
+                statement = self.statements.get(operator)
+                if statement is None:
+                    raise TemplateParseError(reader, f'Unknown operator "{operator}" found in {self.template.name}: ')
+                if operator in ('break', 'continue') and not self._in_loop:
+                    raise TemplateParseError(reader, f'Incorrect operator "{operator}" position found '
+                                                     f'in {self.template.name}: ')
+                if statement.dynamic:
+                    self.standalone = False
+                reader.pos = end
+                chunks.append(statement(stat=stat, arg=arg, template=self.template))
+        self.stop = None
         return chunks
 
 
+# copied into every template, so the helpers are not rebuilt per instance
+NAMESPACE = {
+    '__builtins__': builtins,
+    'tt_str': expression_str,
+    'html_escape': escape,
+    'url_quote': quote,
+    'json_encode': dumps,
+    'squeeze': squeeze,
+    'datetime': datetime
+}
+# compiled modules by (source digest, escaped), for templates whose code does not depend on the loader;
+# unlike the instances, they survive templates that are built for a single render
+COMPILED_CACHE_SIZE = 512
+# argument types Template.render may cache on; floats are left out as 0.0 and -0.0 are equal keys
+RENDER_CACHE_TYPES = frozenset({str, bytes, int, bool, type(None)})
+_COMPILED = {}
+_COMPILED_LOCK = threading.Lock()
+
+
 class Template:
-    regex_tag = re.compile(rf'{_Node.tag[0]}([#,{{,%])')
-    regex_operator = re.compile(rf'{_Node.tag[0]}%{WS}([a-zA-Z0-9_]+)')
-
-    def __init__(self, raw: str, name: str=STR_NAME, autoescape: typing.Callable=None, loader=None):
-        self._auto_escape = None
-        self.namespace = {
-            'tt_str': lambda s: s.decode(ENCODING) if isinstance(s, bytes) else str(s),
-            'html_escape': escape,
-            'url_quote': quote,
-            'json_encode': dumps,
-            'squeeze': lambda s: re.sub(r'[\x00-\x20]+', ' ', s).strip(),
-            'datetime': datetime
-        }
+    def __init__(self, raw: str, name: str=STR_NAME, autoescape: typing.Callable=None, loader=None,
+                 render_cache: int=0, compiled=None):
+        # (loader generation, ancestor files), reused until the loader is reset
+        self._ancestors = None
+        self.namespace = NAMESPACE.copy()
         self.name = name
-        if loader and loader.namespace:
-            self.namespace.update(loader.namespace)
-        self.autoescape = loader.autoescape if loader and loader.autoescape else autoescape
+        self.raw = raw
+        # parsed on demand when the module comes from a cache, only extends needs the tree then
+        self.file = None
+        if loader is not None:
+            if loader.namespace:
+                self.namespace.update(loader.namespace)
+            autoescape = loader.autoescape or autoescape
+            render_cache = loader.render_cache or render_cache
+        # generated code refers to the escape function by a fixed name, which keeps it the same across runs
+        self.autoescape = None
+        if autoescape:
+            self.namespace['tt_escape'] = autoescape
+            self.autoescape = 'tt_escape'
+        # opt-in: only safe when the output depends on nothing but the (hashable) arguments
+        self.cached_render = lru_cache(maxsize=render_cache)(self._render_items) if render_cache else None
+        # whether expressions are escaped is the only setting the generated code depends on
+        key = (hashlib.blake2b(raw.encode(ENCODING), digest_size=16).digest(), self.autoescape is not None)
+        # False when the generated code depends on the loader, i.e. on other templates
+        self.standalone = True
+        self.compiled = compiled or _COMPILED.get(key)
+        if self.compiled is None:
+            self.compile(raw, loader)
+            self.standalone = self.parser.standalone
+        if self.standalone and key not in _COMPILED:
+            with _COMPILED_LOCK:
+                if len(_COMPILED) >= COMPILED_CACHE_SIZE:
+                    # oldest first, dicts keep insertion order
+                    del _COMPILED[next(iter(_COMPILED))]
+                _COMPILED[key] = self.compiled
+        # the module only defines tt_execute, keep its code and defaults and build the function per render
+        namespace = self.namespace.copy()
+        exec(self.compiled, namespace)
+        self.execute = namespace['tt_execute'].__code__
+        self.defaults = namespace['tt_execute'].__defaults__
+        # a body that reads no names and binds no helpers only returns a literal, render it once
+        self.constant = None
+        if not self.execute.co_names and not self.defaults:
+            self.constant = self._render()
+
+    def parse(self, raw: str):
         self.reader = _Reader(raw)
-        self.file = _File(body=_Body(_Parser(self).parse(), template=self), template=self)
-        print('+++++++++++++++')
-        print(self.file.body.chunks)
-        print('+++++++++++++++')
+        self.parser = _Parser(self)
+        self.file = _File(body=_Body(self.parser.parse(), template=self), template=self)
+
+    def compile(self, raw: str, loader):
+        self.parse(raw)
         named_blocks = {}
         ancestors = self.get_ancestors(loader)
         ancestors.reverse()
         for ancestor in ancestors:
             ancestor.find_named_blocks(loader, named_blocks)
-        self.writer = _Writer(ancestors[0].template, named_blocks)
+        writer = _Writer(ancestors[0].template, named_blocks, loader)
         try:
-            ancestors[0].generate()
-            self.compiled = self.writer.output(f"{self.name.replace('.', '_')}.gen.py")
+            ancestors[0].generate(writer)
+            self.compiled = writer.output(f"{self.name.replace('.', '_')}.gen.py")
         finally:
-            self.writer.close()
-
-    @property
-    def autoescape(self):
-        if self._auto_escape:
-            return f'tt_auto_escape_{id(self._auto_escape)}'
-        return None
+            writer.close()
 
-    @autoescape.setter
-    def autoescape(self, func):
-        self._auto_escape = func
-        if func:
-            self.namespace.setdefault(f'tt_auto_escape_{id(func)}', func)
+    def get_file(self):
+        if self.file is None:
+            self.parse(self.raw)
+        return self.file
 
     def get_ancestors(self, loader):
-        ancestors = [self.file]
-        for chunk in self.file.body.chunks:
-            if isinstance(chunk, _StatementExtends):
-                if not loader:
-                    raise TemplateError('{% extends %} block found, but no template loader')
-                template = loader.load(chunk.name)
-                ancestors.extend(template.get_ancestors(loader))
-        return ancestors
+        generation = loader.generation if loader is not None else None
+        if self._ancestors is None or self._ancestors[0] != generation:
+            ancestors = [self.get_file()]
+            for chunk in self.file.body.chunks:
+                if isinstance(chunk, _StatementExtends):
+                    if not loader:
+                        raise TemplateError('{% extends %} block found, but no template loader')
+                    template = loader.load(chunk.name)
+                    ancestors.extend(template.get_ancestors(loader))
+            self._ancestors = (generation, ancestors)
+        # a copy, callers reverse it in place
+        return list(self._ancestors[1])
 
     def render(self, **kwargs):
-        ns = {}
-        ns.update(self.namespace)
-        ns.update(**kwargs)
-        exec(self.compiled, ns, None)
-        execute = ns['tt_execute']
-        linecache.clearcache()
-        return execute()
+        if self.constant is not None:
+            return self.constant
+        if self.cached_render is not None:
+            # 1, 1.0 and True are equal keys but render differently, so the types are part of the key;
+            # that only tells flat values apart, containers such as (1,) and (True,) are rendered directly
+            items = tuple((name, value.__class__, value) for name, value in kwargs.items())
+            if all(item[1] in RENDER_CACHE_TYPES for item in items):
+                return self.cached_render(items)
+        return self._render(**kwargs)
+
+    def _render_items(self, items):
+        return self._render(**{name: value for name, _, value in items})
+
+    def _render(self, **kwargs):
+        # the namespace holds template variables as globals, so it is rebuilt per call;
+        # everything else about tt_execute was prepared at compile time
+        return FunctionType(self.execute, {**self.namespace, **kwargs}, None, self.defaults)()
 
 
 # Loader ######################################################################
 ###############################################################################
 class _Loader:
-    def __init__(self, namespace=None, autoescape=None):
+    def __init__(self, namespace=None, autoescape=None, render_cache: int=0):
         self.namespace = namespace or {}
         self.autoescape = autoescape
+        self.render_cache = render_cache
         self.templates = dict()
         self.lock = threading.RLock()
+        # names being compiled by this thread, a template that extends or includes itself ends up here
+        self.loading = set()
+        # bumped by reset() so templates drop ancestor chains resolved through the old entries
+        self.generation = 0
 
     def reset(self):
         with self.lock:
             self.templates = {}
+            self.generation += 1
 
     def load(self, obj: str) -> Template:
         raise NotImplementedError
@@ -628,21 +866,76 @@ class StringLoader(_Loader):
         self.name = name
 
     def load(self, s: str):
-        if self.name not in self.templates:
+        template = self.templates.get(self.name)
+        if template is None:
             with self.lock:
-                self.templates[self.name] = Template(s, self.name, self.autoescape, self)
-        return self.templates[self.name]
+                template = self.templates.get(self.name)
+                if template is None:
+                    template = self.templates[self.name] = Template(s, self.name, self.autoescape, self)
+        return template
 
 
 class FileLoader(_Loader):
-    def __init__(self, path: str=os.path.dirname(__file__), **kwargs):
+    def __init__(self, path: str=os.path.dirname(__file__), cache_dir: str=None, **kwargs):
         super(FileLoader, self).__init__(**kwargs)
         self.path = os.path.abspath(path)
+        # opt-in: compiled modules of standalone templates, keyed by source, so a new process skips the parse
+        self.cache_dir = cache_dir
 
     def load(self, name: str):
-        if name not in self.templates:
+        # entries are (template, mtime), so an edited file is compiled again
+        file_path = os.path.join(self.path, name)
+        mtime = os.stat(file_path).st_mtime
+        entry = self.templates.get(name)
+        if entry is None or entry[1] != mtime:
             with self.lock:
-                file_path = os.path.abspath(os.path.join(self.path, name))
-                with open(file_path, mode='r', encoding=ENCODING) as f:
-                    self.templates[name] = Template(f.read(), name, self.autoescape, self)
-        return self.templates[name]
+                entry = self.templates.get(name)
+                if entry is None or entry[1] != mtime:
+                    if name in self.loading:
+                        raise TemplateError(f'Circular extends or include through "{name}".')
+                    with open(file_path, mode='r', encoding=ENCODING) as f:
+                        raw = f.read()
+                    self.loading.add(name)
+                    try:
+                        entry = self.templates[name] = (self._load_template(raw, name), mtime)
+                    finally:
+                        self.loading.discard(name)
+        return entry[0]
+
+    def _load_template(self, raw: str, name: str) -> Template:
+        cache_path = self._get_cache_path(raw) if self.cache_dir else None
+        compiled = self._read_cache(cache_path) if cache_path and _private_dir(self.cache_dir) else None
+        template = Template(raw, name, self.autoescape, self, compiled=compiled)
+        if cache_path and compiled is None and template.standalone:
+            self._write_cache(cache_path, template.compiled)
+        return template
+
+    def _get_cache_path(self, raw: str):
+        # whether expressions are escaped is the only setting the generated code depends on
+        digest = hashlib.blake2b(raw.encode(ENCODING), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, ''.join((digest, '.e' if self.autoescape else '', '.tpyc')))
+
+    @staticmethod
+    def _read_cache(cache_path: str):
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+            return None
+        try:
+            return marshal.loads(data[len(CACHE_MAGIC):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def _write_cache(self, cache_path: str, compiled):
+        if not _private_dir(self.cache_dir, create=True):
+            return
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as f:
+                f.write(CACHE_MAGIC + marshal.dumps(compiled))
+            os.replace(f.name, cache_path)
+        except OSError:
+            # the cache is an optimization only
+            pass
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from io import BytesIO
+from http import client
+from unittest import TestCase, mock
+from sampan import client as sampan_client
+from sampan.client import BasicAuthentication, RestClient
+
+
+class FakeSocket:
+    def __init__(self, data):
+        self.data = data
+
+    def makefile(self, *args, **kwargs):
+        return BytesIO(self.data)
+
+
+def make_response(head, body=b'', method='GET'):
+    resp = client.HTTPResponse(FakeSocket(head + b'\r\n' + body), method=method)
+    resp.begin()
+    return resp
+
+
+class TestReadBody(TestCase):
+
+    def test_content_length(self):
+        resp = make_response(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n', b'hello')
+        self.assertEqual(RestClient._read_body(resp), b'hello')
+
+    def test_short_body(self):
+        resp = make_response(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n', b'hello')
+        with self.assertRaises(client.IncompleteRead) as cm:
+            RestClient._read_body(resp)
+        self.assertEqual(cm.exception.partial, b'hello')
+        self.assertEqual(cm.exception.expected, 5)
+
+    def test_no_content_length(self):
+        resp = make_response(b'HTTP/1.1 200 OK\r\nConnection: close\r\n', b'hello')
+        self.assertEqual(RestClient._read_body(resp), b'hello')
+
+    def test_head_does_not_preallocate(self):
+        resp = make_response(b'HTTP/1.1 500 Error\r\nContent-Length: 524288000\r\n', method='HEAD')
+        self.assertEqual(RestClient._read_body(resp), b'')
+
+    def test_body_larger_than_preallocation(self):
+        body = bytes(range(256)) * ((sampan_client._PREALLOC_SIZE * 3) // 256 + 1)
+        resp = make_response(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n' % len(body), body)
+        self.assertEqual(RestClient._read_body(resp), body)
+
+
+class TestUrlencode(TestCase):
+
+    def test_equal_values_of_different_types(self):
+        self.assertEqual(sampan_client._urlencode({'a': 1}), 'a=1')
+        self.assertEqual(sampan_client._urlencode({'a': True}), 'a=True')
+        self.assertEqual(sampan_client._urlencode({'a': 1.0}), 'a=1.0')
+        self.assertEqual(sampan_client._urlencode([('a', 1)]), 'a=1')
+
+    def test_signed_zero(self):
+        self.assertEqual(sampan_client._urlencode({'a': 0.0}), 'a=0.0')
+        self.assertEqual(sampan_client._urlencode({'a': -0.0}), 'a=-0.0')
+
+    def test_nested_values(self):
+        self.assertEqual(sampan_client._urlencode({'a': (1,)}), 'a=%281%2C%29')
+        self.assertEqual(sampan_client._urlencode({'a': (True,)}), 'a=%28True%2C%29')
+        self.assertEqual(sampan_client._urlencode({'a': [1]}), 'a=%5B1%5D')
+
+
+class TestSSLSessions(TestCase):
+
+    def setUp(self):
+        self.sessions = sampan_client._SSL_SESSIONS.copy()
+        sampan_client._SSL_SESSIONS.clear()
+
+    def tearDown(self):
+        sampan_client._SSL_SESSIONS.clear()
+        sampan_client._SSL_SESSIONS.update(self.sessions)
+
+    def test_bounded(self):
+        size = sampan_client._SSL_SESSIONS_SIZE
+        for port in range(size + 10):
+            sampan_client._put_ssl_session(('host', port), object())
+        self.assertEqual(len(sampan_client._SSL_SESSIONS), size)
+        self.assertIsNone(sampan_client._get_ssl_session(('host', 0)))
+        self.assertIsNotNone(sampan_client._get_ssl_session(('host', size + 9)))
+
+    def test_least_recently_used_evicted(self):
+        size = sampan_client._SSL_SESSIONS_SIZE
+        for port in range(size):
+            sampan_client._put_ssl_session(('host', port), object())
+        sampan_client._get_ssl_session(('host', 0))
+        sampan_client._put_ssl_session(('other', 443), object())
+        self.assertIsNotNone(sampan_client._get_ssl_session(('host', 0)))
+        self.assertIsNone(sampan_client._get_ssl_session(('host', 1)))
+
+    def connect(self, tunnel_host=None):
+        conn = sampan_client._HTTPSConnection('proxy', 8080, context=mock.Mock())
+        if tunnel_host:
+            conn.set_tunnel(tunnel_host, 443)
+        conn._context.wrap_socket.return_value.session = tunnel_host or 'proxy'
+        conn._context.wrap_socket.return_value.session_reused = False
+        with mock.patch.object(client.HTTPConnection, 'connect'):
+            conn.connect()
+        return conn._context.wrap_socket.call_args[1]['session']
+
+    def test_keyed_by_tunnel_host(self):
+        self.assertIsNone(self.connect('a'))
+        self.assertIsNone(self.connect('b'))
+        self.assertIsNone(self.connect())
+        self.assertEqual(self.connect('a'), 'a')
+        self.assertEqual(self.connect('b'), 'b')
+        self.assertEqual(self.connect(), 'proxy')
+
+
+class TestBasicAuthentication(TestCase):
+
+    def test_value(self):
+        auth = BasicAuthentication('user', 'pass')
+        self.assertEqual(auth.get_value(), 'Basic dXNlcjpwYXNz')
+        auth.reset('other', 'secret')
+        self.assertEqual(auth.get_value(), 'Basic b3RoZXI6c2VjcmV0')
+
+    def test_password_not_kept(self):
+        auth = BasicAuthentication('user', 'pass')
+        self.assertEqual(auth.username, 'user')
+        self.assertFalse(hasattr(auth, 'password'))
+        self.assertNotIn('pass', vars(auth).values())
+        auth.reset('other', 'secret')
+        self.assertEqual(auth.username, 'other')
@@ -6,7 +6,7 @@ import pathlib
 from io import StringIO
 from unittest import TestCase
 from tempfile import NamedTemporaryFile
-from sampan.properties import Properties
+from sampan.properties import Properties, PropertiesError
 
 
 class TestProperties(TestCase):
@@ -20,6 +20,10 @@ class TestProperties(TestCase):
         print(str(props))
         self.assertTrue(str(props) == "{key=another_value}")
 
+    def test_str(self):
+        self.assertEqual('{}', str(Properties()))
+        self.assertEqual('{a=b, c=d}', str(Properties({'a': 'b', 'c': 'd'})))
+
     def test_iterable_properties(self):
         d = dict([("a", "b"), ("c", "d"), ("e", "f")])
         props = Properties(d)
@@ -54,6 +58,11 @@ class TestProperties(TestCase):
         props.update({"g": "h", "c": "i"})
         self.assertTrue(props == Properties(dict([("a", "b"), ("c", "i"), ("e", "f"), ("g", "h")])))
 
+    def test_missing_attribute(self):
+        props = Properties()
+        self.assertFalse(hasattr(props, 'toto'))
+        self.assertRaises(AttributeError, getattr, props, 'toto')
+
     def test_delete(self):
         d = dict([("a", "b"), ("c", "d"), ("e", "f")])
         props = Properties(d)
@@ -74,6 +83,19 @@ class TestProperties(TestCase):
             props.load(f)
         self.assertEqual('Welcome to Wikipedia!', props.getProperty('message'))
 
+    def test_load_escaped_tail(self):
+        props = Properties()
+        props.load(StringIO('a = b\\\\\nc = d\\\n  e\nf = g\\'))
+        self.assertEqual(Properties({'a': 'b\\', 'c': 'de', 'f': 'g'}), props)
+
+    def test_unescape(self):
+        self.assertEqual('a\tb:c=d', Properties.unescape(r'a\tb\:c\=d'))
+        self.assertEqual('A\u00e9', Properties.unescape(r'\u0041\u00e9'))
+        self.assertEqual('caf\u00e9', Properties.unescape('caf\u00e9'))
+        self.assertEqual('C:\\new', Properties.unescape(r'C\:\\new'))
+        self.assertEqual('a|b', Properties.unescape(r'a\|b'))
+        self.assertRaises(PropertiesError, Properties.unescape, r'\u00')
+
     def test_store(self):
         properties = """foo : bar\nbar : baz\n"""
         p = Properties()
@@ -85,6 +107,25 @@ class TestProperties(TestCase):
             p2.load(f)
         self.assertEqual(p, p2)
 
+    def test_store_binary(self):
+        p = Properties({'foo': 'bar', 'bar': 'baz'})
+        p2 = Properties()
+        with NamedTemporaryFile(delete=False, mode='wb') as f:
+            p.store(f)
+        with open(f.name, encoding='latin-1') as f:
+            p2.load(f)
+        self.assertEqual(p, p2)
+
+    def test_store_escaped(self):
+        p = Properties({'a:b': 'c=d', 'path': 'C:\\dir\tx', 'lines': 'one\ntwo', 'x|y': 'z|w',
+                        'a\\': 'v\\', ' k': ' v ', 'k ey': ' ', '#c': '#d', '!e': '!f'})
+        p2 = Properties()
+        with NamedTemporaryFile(delete=False, mode='w') as f:
+            p.store(f)
+        with open(f.name) as f:
+            p2.load(f)
+        self.assertEqual(p, p2)
+
     def test_store_comments(self):
         properties = """foo : bar\nbar : baz\n"""
         comment = 'This is comments'
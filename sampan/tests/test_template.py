@@ -2,7 +2,12 @@
 # coding: utf-8
 
 from unittest import TestCase
-from ..templateNG import Template, _StatementIf
+import os
+import tempfile
+from unittest import mock
+from .. import templateNG
+from ..templateNG import Template, TemplateParseError, _StatementIf
+from .. import template as tt
 from html import escape
 from pprint import pprint
 
@@ -154,3 +159,240 @@ class TestTemplate(TestCase):
         t = Template(sts_for)
         print(t.render(students=('toto', 'haha')))
 
+
+    def test_render_cache_types(self):
+        t = Template("""<p>{{ x }}</p>""", render_cache=8)
+        self.assertEqual(t.render(x=1), '<p>1</p>')
+        self.assertEqual(t.render(x=True), '<p>True</p>')
+        self.assertEqual(t.render(x=1.0), '<p>1.0</p>')
+        self.assertEqual(t.render(x=1), '<p>1</p>')
+        self.assertEqual(t.render(x=[1]), '<p>[1]</p>')
+
+    def test_render_cache_nested_types(self):
+        t = Template("""{{ x }}""", render_cache=8)
+        self.assertEqual(t.render(x=(1,)), '(1,)')
+        self.assertEqual(t.render(x=(True,)), '(True,)')
+        self.assertEqual(t.render(x=((1, 2),)), '((1, 2),)')
+        self.assertEqual(t.render(x=((1.0, 2),)), '((1.0, 2),)')
+        self.assertEqual(t.render(x=frozenset({1})), 'frozenset({1})')
+        self.assertEqual(t.render(x=frozenset({1.0})), 'frozenset({1.0})')
+        self.assertEqual(t.render(x=0.0), '0.0')
+        self.assertEqual(t.render(x=-0.0), '-0.0')
+
+    def test_sts_unclosed(self):
+        with self.assertRaises(TemplateParseError):
+            Template("""{% if x %}abc""")
+        with self.assertRaises(TemplateParseError):
+            Template("""{% for x in y %}{% if x %}abc{% end %}""")
+
+    def test_sts_clause_of_outer_block(self):
+        with self.assertRaises(TemplateParseError):
+            Template("""{% if a %}{% for x in y %}A{% else %}B{% end %}""")
+
+
+    def test_constant(self):
+        txt = """<p>{# comment #}static {text}</p>\n"""
+        for autoescape in (None, escape):
+            t = Template(txt, autoescape=autoescape)
+            self.assertIsNotNone(t.constant)
+            self.assertEqual(t.render(), '<p>static {text}</p>\n')
+            self.assertEqual(t.render(x=b'ignored'), '<p>static {text}</p>\n')
+        self.assertIsNone(Template("""<p>{{ x }}</p>""").constant)
+
+    def test_no_buffer_without_control_flow(self):
+        t = Template("""<p>{{ a }}</p>{% raw b %}""")
+        self.assertNotIn('tt_buffer', t.execute.co_varnames)
+        self.assertEqual(t.render(a=1, b='<'), '<p>1</p><')
+        self.assertIn('tt_buffer', Template("""{% if a %}<p>{{ a }}</p>{% end %}""").execute.co_varnames)
+
+    def test_disk_cache_version(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            cache_dir = os.path.join(base_dir, 'cache')
+            with open(os.path.join(base_dir, 'page.html'), 'w') as f:
+                f.write("""<p>{{ x }}</p>""")
+            loader = templateNG.FileLoader(base_dir, cache_dir=cache_dir)
+            self.assertEqual(loader.load('page.html').render(x=1), '<p>1</p>')
+            cache_path, = (os.path.join(cache_dir, name) for name in os.listdir(cache_dir))
+            self.assertIsNotNone(loader._read_cache(cache_path))
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            # the same entry written by another sampan release
+            stale = data.replace(templateNG.CACHE_MAGIC, templateNG.CACHE_MAGIC.replace(b':', b'.0:'), 1)
+            with open(cache_path, 'wb') as f:
+                f.write(stale)
+            self.assertIsNone(loader._read_cache(cache_path))
+
+    def test_compiled_cache_eviction(self):
+        with mock.patch.dict(templateNG._COMPILED, clear=True):
+            for i in range(templateNG.COMPILED_CACHE_SIZE + 1):
+                Template(f"""<p>{i}{{{{ x }}}}</p>""")
+            self.assertEqual(len(templateNG._COMPILED), templateNG.COMPILED_CACHE_SIZE)
+            self.assertEqual(Template("""<p>0{{ x }}</p>""").render(x=1), '<p>01</p>')
+            self.assertEqual(len(templateNG._COMPILED), templateNG.COMPILED_CACHE_SIZE)
+
+    def test_fused_matches_unfused(self):
+        txt = """<p a='{b}'>{{ a }}\\n{% raw b %}"{{ c }}</p>{% if a %}<i>{{ a }}{{ b }}</i>{% end %}"""
+        kwargs = dict(a='<x>', b=b'caf\xc3\xa9', c=1.5)
+        for autoescape in (None, escape):
+            with mock.patch.dict(templateNG._COMPILED, clear=True):
+                fused = Template(txt, autoescape=autoescape).render(**kwargs)
+            with mock.patch.dict(templateNG._COMPILED, clear=True), \
+                    mock.patch.object(templateNG._Body, '_optimize', lambda self: None), \
+                    mock.patch.object(templateNG._File, 'generate', unfused_generate):
+                unfused = Template(txt, autoescape=autoescape).render(**kwargs)
+            self.assertEqual(fused, unfused)
+
+    def test_extends(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            files = {
+                'base.html': '<b>{% if x %}{% block body %}-{% end %}{% end %}</b>',
+                'a.html': '{% extends "base.html" %}{% block body %}a{{ x }}{% end %}',
+                'b.html': '{% extends "base.html" %}{% block body %}{% include "c.html" %}{% end %}',
+                'c.html': '{% autoescape None %}c{{ x }}',
+            }
+            for name, text in files.items():
+                with open(os.path.join(base_dir, name), 'w') as f:
+                    f.write(text)
+            loader = templateNG.FileLoader(base_dir, autoescape=escape)
+            loads = []
+            load = loader.load
+            loader.load = lambda name: loads.append(name) or load(name)
+            self.assertEqual(load('a.html').render(x='<'), '<b>a&lt;</b>')
+            self.assertEqual(load('b.html').render(x='<'), '<b>c<</b>')
+            self.assertEqual(load('base.html').render(x=1), '<b>-</b>')
+            # the parent is parsed and walked once, the second child reuses its chain
+            self.assertEqual(loads, ['base.html', 'base.html', 'c.html', 'c.html'])
+            base = load('base.html')
+            self.assertIs(load('b.html').get_ancestors(loader)[1], base.file)
+
+    def test_circular_extends(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            for name, parent in (('a.html', 'b.html'), ('b.html', 'a.html')):
+                with open(os.path.join(base_dir, name), 'w') as f:
+                    f.write(f'{{% extends "{parent}" %}}')
+            with self.assertRaises(templateNG.TemplateError):
+                templateNG.FileLoader(base_dir).load('a.html')
+
+
+def unfused_generate(self, writer):
+    # _File.generate without the single f-string return, so every chunk is appended on its own
+    header = len(writer.lines)
+    writer.write_line('def tt_execute():')
+    with writer.indent():
+        writer.write_line('tt_buffer = []')
+        writer.write_line('tt_append = tt_buffer.append')
+        self.body.generate(writer)
+        writer.write_line("return ''.join(tt_buffer)")
+    arguments = ', '.join(f'{name}={name}' for name in writer.bindings)
+    writer.lines[header] = f'def tt_execute({arguments}):'
+
+
+class TestTornadoTemplate(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_dir = self.tmp.name
+        self.cache_dir = os.path.join(self.base_dir, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text, mtime=None):
+        path = os.path.join(self.base_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_file_loader_cache_mtime(self):
+        path = self.write('page.html', 'one {{ x }}', mtime=1000000000)
+        loader = tt.FileLoader(self.base_dir, cache_dir=self.cache_dir)
+        self.assertEqual(loader.load('page.html').generate(x=1), 'one 1')
+        loader = tt.FileLoader(self.base_dir, cache_dir=self.cache_dir)
+        self.assertIsNotNone(loader._read_cache('page.html', path, os.stat(path), b'one {{ x }}'))
+        # same size, so only the mtime tells the cache entry is stale
+        path = self.write('page.html', 'two {{ x }}', mtime=1000000100)
+        self.assertIsNone(loader._read_cache('page.html', path, os.stat(path), b'two {{ x }}'))
+        self.assertEqual(loader.load('page.html').generate(x=1), 'two 1')
+
+    def test_file_loader_cache_not_private(self):
+        path = self.write('page.html', '{{ x }}')
+        loader = tt.FileLoader(self.base_dir, cache_dir=self.cache_dir)
+        loader.load('page.html').generate(x=1)
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+        os.chmod(self.cache_dir, 0o777)
+        self.assertIsNone(loader._read_cache('page.html', path, os.stat(path), b'{{ x }}'))
+
+    def test_file_loader_cache_version(self):
+        path = self.write('page.html', 'version {{ x }}')
+        loader = tt.FileLoader(self.base_dir, cache_dir=self.cache_dir)
+        loader.load('page.html').generate(x=1)
+        self.assertIsNotNone(loader._read_cache('page.html', path, os.stat(path), b'version {{ x }}'))
+        cache_path = loader._get_cache_path(path)
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        # the same entry written by another sampan release
+        with open(cache_path, 'wb') as f:
+            f.write(data.replace(tt.CACHE_MAGIC, tt.CACHE_MAGIC.replace(b':', b'.0:'), 1))
+        self.assertIsNone(loader._read_cache('page.html', path, os.stat(path), b'version {{ x }}'))
+
+    def test_file_loader_no_cache_by_default(self):
+        self.assertIsNone(tt.FileLoader(self.base_dir).cache_dir)
+
+    def test_circular_extends(self):
+        self.write('a.html', '{% extends "b.html" %}')
+        self.write('b.html', '{% extends "a.html" %}')
+        loader = tt.FileLoader(self.base_dir)
+        with self.assertRaises(tt.TemplateError):
+            loader.load('a.html').generate()
+
+    def test_ancestors_memoized(self):
+        self.write('base.html', '<b>{% block body %}{% end %}</b>')
+        self.write('a.html', '{% extends "base.html" %}{% block body %}a{% end %}')
+        self.write('b.html', '{% extends "base.html" %}{% block body %}b{% end %}')
+        loader = tt.FileLoader(self.base_dir)
+        loads = []
+        load = loader.load
+        loader.load = lambda name, parent_name=None: loads.append(name) or load(name, parent_name)
+        a, b = load('a.html'), load('b.html')
+        self.assertEqual(a.generate(), '<b>a</b>')
+        self.assertEqual(b.generate(), '<b>b</b>')
+        base = load('base.html')
+        self.assertIs(base._ancestors[0], loader)
+        walked = base._ancestors
+        a._get_ancestors(loader)
+        self.assertEqual(loads, ['base.html', 'base.html'])
+        self.assertIs(base._ancestors, walked)
+
+    def test_error_lineno(self):
+        for text, message, lineno in (('a\nb\n{{ }}', 'Empty expression', 3),
+                                      ('{# a\nb #}\nc\n{% foo %}', 'unknown operator: foo', 4),
+                                      ('{{ a\n}}{% if a %}\n{% while b %}{% end %}\n{% continue %}{% end %}',
+                                       'continue outside', 4)):
+            with self.assertRaises(tt.TemplateError) as cm:
+                tt.Template(text)
+            self.assertIn(message, cm.exception.message)
+            self.assertEqual(cm.exception.lineno, lineno)
+
+    def test_intermediate_outside_block(self):
+        with self.assertRaisesRegex(tt.TemplateError, 'else outside for, if, try, while block'):
+            tt.Template('{% else %}')
+        with self.assertRaisesRegex(tt.TemplateError, 'elif block cannot be attached to for block'):
+            tt.Template('{% for x in y %}{% elif x %}{% end %}')
+        with self.assertRaisesRegex(tt.TemplateError, 'break outside for, while block'):
+            tt.Template('{% for x in y %}{% apply str.upper %}{% break %}{% end %}{% end %}')
+
+    def test_nested_control_blocks(self):
+        t = tt.Template('{% for i in range(4) %}{% if i % 2 %}{{ i }}{% else %}'
+                        '{% while True %}{% try %}{{ 1 // i }}{% except ZeroDivisionError %}z{% end %}'
+                        '{% break %}{% end %}{% end %}{% end %}')
+        self.assertEqual(t.generate(), 'z103')
+
+    def test_apply_static_body(self):
+        t = tt.Template('{% apply str.upper %}a<b{% end %}')
+        self.assertEqual(t.generate(), 'A<B')
+        self.assertNotIn('_tt_apply', t.code)
+        t = tt.Template('{% apply str.upper %}a{{ x }}{% end %}')
+        self.assertEqual(t.generate(x='<b>'), 'A&LT;B&GT;')
+        self.assertIn('_tt_apply', t.code)